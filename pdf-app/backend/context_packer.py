@@ -0,0 +1,102 @@
+import re
+
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_HEADER = "search results:\n\n"
+CHUNK_SEPARATOR = "\n\n"
+
+
+def get_token_counter(model_name):
+    """
+    Count tokens with the target model's tokenizer.
+    Falls back to ~4 characters per token when tiktoken, or its encoding for the model, is unavailable,
+    including when the encoding cannot be downloaded.
+    """
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(model_name)
+    except Exception as e:
+        print(f"[WARNING] No tokenizer for {model_name} ({e}), estimating tokens from characters.")
+        return lambda text: len(text) // 4 + 1
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class PackedContext:
+    """
+    Chunks chosen for a prompt, with what it cost.
+
+    attributes:
+        chunks: List[str]
+            Chunks that fit, in relevance order.
+        ids: List[int]
+            Position of each kept chunk in the candidates passed to pack().
+        n_tokens: int
+            Tokens used by the rendered context, header and separators included.
+        n_duplicates: int
+            Candidates dropped because they repeat a kept chunk.
+        n_over_budget: int
+            Candidates dropped because they did not fit in what was left of the budget.
+    """
+
+    def __init__(self, n_tokens=0):
+        self.chunks = []
+        self.ids = []
+        self.n_tokens = n_tokens
+        self.n_duplicates = 0
+        self.n_over_budget = 0
+
+    def render(self):
+        return CONTEXT_HEADER + "".join(c + CHUNK_SEPARATOR for c in self.chunks)
+
+
+class ContextPacker:
+    """
+    Fill a token budget with retrieved chunks, most relevant first.
+    Replaces appending every neighbor to the prompt, which overflowed the context with long chunks.
+
+    args:
+        model_name: str
+            LLM the prompt is for; picks the tokenizer.
+        budget: int
+            Max tokens for the search results part of the prompt.
+
+    methods:
+        pack(chunks: List[str], texts: List[str]) -> PackedContext:
+            chunks are in relevance order. texts, if given, are the chunks without their citation prefix;
+            duplicates are found on them, so the same boilerplate on two pages is only kept once.
+    """
+
+    def __init__(self, model_name, budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+        self.budget = budget
+        self.count_tokens = get_token_counter(model_name)
+        self.separator_tokens = self.count_tokens(CHUNK_SEPARATOR)
+
+    def pack(self, chunks, texts=None):
+        packed = PackedContext(n_tokens=self.count_tokens(CONTEXT_HEADER))
+        seen = set()
+        for i, chunk in enumerate(chunks):
+            key = re.sub(r"\s+", " ", texts[i] if texts is not None else chunk).strip()
+            if key in seen:
+                packed.n_duplicates += 1
+                continue
+            n_tokens = self.count_tokens(chunk) + self.separator_tokens
+            if packed.n_tokens + n_tokens > self.budget:
+                # A shorter, less relevant chunk may still fit.
+                packed.n_over_budget += 1
+                continue
+            seen.add(key)
+            packed.chunks.append(chunk)
+            packed.ids.append(i)
+            packed.n_tokens += n_tokens
+        print(
+            "[DEBUG] Packed %s of %s chunks in %s tokens (%s duplicates, %s over budget)."
+            % (
+                len(packed.chunks),
+                len(chunks),
+                packed.n_tokens,
+                packed.n_duplicates,
+                packed.n_over_budget,
+            )
+        )
+        return packed
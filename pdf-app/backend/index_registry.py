@@ -0,0 +1,128 @@
+import threading
+from collections import OrderedDict
+
+from workflows.nn_index import resident_nbytes
+
+
+# Memory cap for all indexes held by one API process.
+# Embedding matrices dominate: all-MiniLM-L6-v2 is 384 float32s, ~1.5 KB per chunk,
+# or 384 bytes with an int8 index.
+DEFAULT_MAX_BYTES = 1 << 30  # 1 GiB
+
+
+class DocumentIndex:
+    """
+    Everything the chat routes need to answer questions about one PDF.
+
+    args:
+        doc_id: str
+            Key of the document in the registry (content hash of the PDF).
+        model: SemanticSearchModel
+            Fitted semantic search model over the chunks of the PDF.
+            model.data holds the chunks, as a ChunkBuffer or a list of strings.
+        source: str
+            Where the PDF came from (file path or URL), for logging only.
+    """
+
+    def __init__(self, doc_id, model, source=None):
+        self.doc_id = doc_id
+        self.model = model
+        self.source = source
+
+    @property
+    def n_chunks(self):
+        return len(self.model.data)
+
+    @property
+    def nbytes(self):
+        """
+        Approximate resident size: the index, the embedding matrix unless it is memory-mapped,
+        and the chunk text. An exact index scans its vectors on every query,
+        so it counts them in full even when they are the memory-mapped embeddings.
+        """
+        n = 0
+        nn = getattr(self.model, "nn", None)
+        embeddings = getattr(self.model, "embeddings", None)
+        if hasattr(nn, "nbytes"):
+            n += nn.nbytes
+        if embeddings is not None and embeddings is not getattr(nn, "vectors", None):
+            n += resident_nbytes(embeddings)
+        data = self.model.data
+        n += data.nbytes if hasattr(data, "nbytes") else sum(len(c) for c in data)
+        return n
+
+
+class IndexRegistry:
+    """
+    LRU registry of per-document indexes, keyed by doc_id.
+    Replaces the single global M_search so that many users and documents
+    can share one API process without overwriting each other.
+
+    args:
+        max_bytes: int
+            Evict least recently used documents once the sum of their nbytes exceeds this.
+        max_entries: int
+            Optional cap on the number of documents, regardless of size.
+
+    methods:
+        get(doc_id: str) -> Optional[DocumentIndex]:
+            Returns the document and marks it as most recently used.
+        put(doc_index: DocumentIndex) -> None:
+            Inserts or replaces a document, then evicts to stay under the caps.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._entries
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, doc_id):
+        with self._lock:
+            doc_index = self._entries.get(doc_id)
+            if doc_index is not None:
+                self._entries.move_to_end(doc_id)
+            return doc_index
+
+    def put(self, doc_index):
+        with self._lock:
+            self._pop(doc_index.doc_id)
+            size = doc_index.nbytes
+            self._entries[doc_index.doc_id] = doc_index
+            self._sizes[doc_index.doc_id] = size
+            self._nbytes += size
+            self._evict(keep=doc_index.doc_id)
+
+    def remove(self, doc_id):
+        with self._lock:
+            return self._pop(doc_id)
+
+    def _pop(self, doc_id):
+        doc_index = self._entries.pop(doc_id, None)
+        if doc_index is not None:
+            self._nbytes -= self._sizes.pop(doc_id)
+        return doc_index
+
+    def _evict(self, keep):
+        # Never evict the document that was just inserted, even if it alone exceeds the cap.
+        while len(self._entries) > 1 and (
+            self._nbytes > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            doc_id = next(iter(self._entries))
+            if doc_id == keep:
+                break
+            self._pop(doc_id)
+            print("[INFO] Evicted document index:", doc_id)
@@ -0,0 +1,146 @@
+import time
+import uuid
+import asyncio
+import traceback
+from collections import OrderedDict
+from streaming import sse_event
+
+
+DEFAULT_MAX_WORKERS = 2
+DEFAULT_MAX_JOBS = 1000  # Finished jobs kept around for status requests.
+
+
+def no_progress(stage, **info):
+    """
+    Progress callback for when nobody is listening, e.g. synchronous uploads.
+    """
+
+
+class IngestionJob:
+    """
+    One PDF going through the ingestion pipeline.
+    Stages report progress through job.report(stage, **info); every report is kept as an event.
+
+    args:
+        source: str
+            File path or URL being ingested, for display only.
+    """
+
+    def __init__(self, source=None):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.status = "queued"
+        self.stage = None
+        self.events = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    @property
+    def done(self):
+        return self.status in ("succeeded", "failed")
+
+    def report(self, stage, **info):
+        self.stage = stage
+        self.updated_at = time.time()
+        self.events.append({"stage": stage, "time": self.updated_at, **info})
+        print(f"[INFO] Job {self.id} {stage}:", info)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "source": self.source,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.events[-1] if self.events else None,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+class JobManager:
+    """
+    Runs ingestion jobs as asyncio tasks, at most max_workers at a time,
+    so upload requests return right away.
+    Jobs are coroutines; they are expected to push their CPU-heavy stages to an executor.
+
+    args:
+        max_workers: int
+            PDFs ingested concurrently.
+        max_jobs: int
+            Jobs remembered for status requests; the oldest finished ones are forgotten first.
+
+    methods:
+        submit(fn: Callable, *args, source: str) -> IngestionJob:
+            Schedules await fn(*args, progress=job.report); its return value becomes job.result.
+            Must be called from the event loop.
+        get(job_id: str) -> Optional[IngestionJob]
+        stream(job_id: str) -> AsyncIterator[str]:
+            Server-sent events for every progress report, until the job is done.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_jobs=DEFAULT_MAX_JOBS):
+        self.max_jobs = max_jobs
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._jobs = OrderedDict()
+        self._tasks = set()
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def submit(self, fn, *args, source=None):
+        job = IngestionJob(source=source)
+        self._jobs[job.id] = job
+        self._forget_finished()
+        job.report("queued")
+        task = asyncio.get_running_loop().create_task(self._run(job, fn, *args))
+        # The loop only keeps weak references to tasks.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def _run(self, job, fn, *args):
+        async with self._semaphore:
+            await self._run_job(job, fn, *args)
+
+    async def _run_job(self, job, fn, *args):
+        job.status = "running"
+        try:
+            job.result = await fn(*args, progress=job.report)
+            # Report before flipping the status, so streams never end before the last event.
+            job.report("done")
+            job.status = "succeeded"
+        except Exception as e:
+            traceback.print_exc()
+            job.error = str(e)
+            job.report("failed", error=job.error)
+            job.status = "failed"
+
+    def _forget_finished(self):
+        n_over = len(self._jobs) - self.max_jobs
+        for job_id in [j.id for j in self._jobs.values() if j.done][:max(n_over, 0)]:
+            del self._jobs[job_id]
+
+    async def stream(self, job_id, poll_interval=0.25):
+        job = self.get(job_id)
+        if job is None:
+            yield sse_event("error", {"message": f"Unknown job {job_id}."})
+            return
+        n_sent = 0
+        while True:
+            # Events only ever get appended, so sending from the last index is enough.
+            events = job.events[n_sent:]
+            for event in events:
+                yield sse_event("progress", event)
+            n_sent += len(events)
+            if job.done and n_sent == len(job.events):
+                yield sse_event("done", job.to_dict())
+                return
+            await asyncio.sleep(poll_interval)
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
@@ -1,8 +1,25 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from routers import pdf_chat
+from fastapi.responses import JSONResponse
+from startup import startup_report
+
+with startup_report.phase("import routers.pdf_chat"):
+    from routers import pdf_chat
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Warm up in the background: /healthz answers right away, /readyz once models are loaded.
+    warmup = asyncio.create_task(pdf_chat.warmup(startup_report))
+    yield
+    warmup.cancel()
+    await pdf_chat.shutdown()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -14,6 +31,23 @@ app.add_middleware(
 
 app.include_router(pdf_chat.router)
 
+
+@app.get("/healthz")
+async def liveness():
+    """
+    The process is up and serving. Does not wait for warmup.
+    """
+    return {"status": "alive"}
+
+
+@app.get("/readyz")
+async def readiness():
+    """
+    503 until warmup has loaded every heavy resource, with per-phase startup timings.
+    """
+    report = startup_report.to_dict()
+    return JSONResponse(content=report, status_code=200 if startup_report.ready else 503)
+
 if __name__ == "__main__":
     import uvicorn
 
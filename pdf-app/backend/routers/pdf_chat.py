@@ -1,44 +1,44 @@
+# Heavy dependencies (sentence-transformers, onnxruntime, sklearn, metaflow, fitz) are imported
+# where they are first used, so importing this module stays fast; warmup() loads them ahead of traffic.
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
-import re
 import os
 import json
-import subprocess
-import requests
-
-
-try:
-    import pymupdf as fitz  # available with v1.24.3
-except ImportError:
-    import fitz
+import asyncio
+import functools
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+import httpx
 import numpy as np
-from openai import OpenAI
-from fitz import Document as FitzDocument
+from openai import AsyncOpenAI
 from fastapi import APIRouter, UploadFile
-from fastapi.responses import JSONResponse
-from sklearn.neighbors import NearestNeighbors
-from sentence_transformers import SentenceTransformer
-from metaflow import Runner, Flow
+from fastapi.responses import JSONResponse, StreamingResponse
+from index_registry import DocumentIndex, IndexRegistry, DEFAULT_MAX_BYTES
+from ingestion_jobs import JobManager, no_progress
+from streaming import JsonFieldStreamer, sse_event
+from context_packer import ContextPacker, DEFAULT_CONTEXT_TOKEN_BUDGET
+from caches import TTLCache
+from workflows.index_store import IndexStore, content_hash
+from workflows.embedding_cache import EmbeddingCache
+from workflows.encoders import check_parity, encoder_name, load_encoder
+from workflows.nn_index import make_index
+from workflows.bm25 import HybridSearch
+from workflows.pdf_utils import (
+    ChunkBuffer,
+    iter_pdf_pages,
+    iter_chunk_spans,
+    make_pdf_executor,
+    strip_citation,
+    warm_pdf_worker,
+)
 
 router = APIRouter()
 
-### Global variables ###
-pdf = None
-# Routes provided in pdf_chat.py assume a single PDF in memory.
-# TODO: Fix this if we want to support multiple PDFs or multiple users.
-text_ls = None  # List of text from the PDF.
-chunks = None  # List of vectors/embeddings.
-
-### Keys
-assert "OPENAI_API_KEY" in os.environ, "Please set OPENAI_API_KEY environment variable."
-oai_compatible_client = OpenAI(
-    api_key=os.getenv("OPENAI_API_KEY"),
-    # base_url="http://0.0.0.0:8000/v1", api_key="not-used" # NIM
-)
-
 ### Tuning and model selection. ###
 DEFAULT_WORD_LENGTH = 100
 DEFAULT_BATCH_SIZE = 1000
+# Chunks per encode call while a PDF is still being extracted.
+DEFAULT_STREAM_BATCH_SIZE = 256
 DEFAULT_N_NEIGHBORS = 8
 TEXT_EMBEDDING_MODEL_INFO = {
     "model_name": "all-MiniLM-L6-v2",
@@ -56,12 +56,114 @@ LLM_MODEL_INFO = {
     "use_case": "document-chat",
 }
 FLOW_NAME = "PDFRAGIndexing"
+INDEX_REGISTRY_MAX_BYTES = int(
+    os.getenv("INDEX_REGISTRY_MAX_BYTES", DEFAULT_MAX_BYTES)
+)
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", 2))
+# Threads for blocking work (PDF parsing, encoding, disk I/O) that must stay off the event loop.
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", min(4, os.cpu_count() or 1)))
+DOWNLOAD_TIMEOUT = 60.0
+# Bump when the summary prompt in pdf_to_rag changes, so cached summaries are not reused.
+SUMMARY_PROMPT_VERSION = 1
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", 1000))
+SUMMARY_CACHE_TTL = float(os.getenv("SUMMARY_CACHE_TTL", 24 * 60 * 60))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", 10_000))
+# Nearest neighbor backend per document: "exact", "hnsw" or "ivf", see workflows/nn_index.py.
+INDEX_BACKEND = os.getenv("INDEX_BACKEND", "exact")
+INDEX_PARAMS = json.loads(os.getenv("INDEX_PARAMS", "{}"))
+# BM25 prefilter + dense rerank parameters, see workflows/bm25.py. Unset means dense search only.
+HYBRID_PARAMS = json.loads(os.getenv("HYBRID_PARAMS", "null"))
+# Max tokens of search results in a prompt, counted with the LLM's tokenizer.
+CONTEXT_TOKEN_BUDGET = int(
+    os.getenv("CONTEXT_TOKEN_BUDGET", DEFAULT_CONTEXT_TOKEN_BUDGET)
+)
+# Encoder for chunks and queries: "torch" (sentence-transformers) or "onnx", see workflows/encoders.py.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# e.g. {"quantize": true, "num_threads": 4}
+EMBEDDING_PARAMS = json.loads(os.getenv("EMBEDDING_PARAMS", "{}"))
+# Compare the encoder with PyTorch on sample texts when it loads; needs torch in the image.
+EMBEDDING_PARITY_CHECK = os.getenv("EMBEDDING_PARITY_CHECK", "0") == "1"
+# Key for cached embeddings and stored indexes; quantized encoders do not share entries with float ones.
+EMBEDDING_MODEL_KEY = encoder_name(
+    TEXT_EMBEDDING_MODEL_INFO["model_name"], EMBEDDING_BACKEND, **EMBEDDING_PARAMS
+)
+# Processes extracting pages of one PDF in parallel.
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", min(4, os.cpu_count() or 1)))
+
 
+_embedding_model = None
+_embedding_cache = None
+_pdf_executor = None
+_openai_client = None
+_context_packer = None
+# Query embeddings are shared by all documents, since they all use the same embedding model.
+query_embedding_cache = TTLCache(maxsize=QUERY_CACHE_SIZE)
 
-# A model container M_search.
+
+def get_openai_client():
+    """
+    Build the OpenAI client on first use. Fails then, not at import, when the key is missing.
+    """
+    global _openai_client
+    if _openai_client is None:
+        if "OPENAI_API_KEY" not in os.environ:
+            raise RuntimeError("Please set OPENAI_API_KEY environment variable.")
+        _openai_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            # base_url="http://0.0.0.0:8000/v1", api_key="not-used" # NIM
+        )
+    return _openai_client
+
+
+def get_embedding_model():
+    """
+    Load the embedding model once per process, on the EMBEDDING_BACKEND encoder.
+    Every per-document SemanticSearchModel shares it.
+    """
+    global _embedding_model
+    if _embedding_model is None:
+        model_name = TEXT_EMBEDDING_MODEL_INFO["model_name"]
+        _embedding_model = load_encoder(model_name, EMBEDDING_BACKEND, **EMBEDDING_PARAMS)
+        if EMBEDDING_PARITY_CHECK and EMBEDDING_BACKEND != "torch":
+            check_parity(_embedding_model, load_encoder(model_name, "torch"))
+    return _embedding_model
+
+
+def get_pdf_executor():
+    """
+    Start the page extraction processes once per API process, not once per PDF.
+    """
+    global _pdf_executor
+    if _pdf_executor is None and PDF_WORKERS > 1:
+        _pdf_executor = make_pdf_executor(PDF_WORKERS)
+    return _pdf_executor
+
+
+def get_embedding_cache():
+    """
+    Open the chunk embedding cache once per process.
+    Identical chunks across PDFs and uploads are encoded once.
+    """
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache(EMBEDDING_MODEL_KEY)
+    return _embedding_cache
+
+
+def get_context_packer():
+    """
+    Load the LLM tokenizer once per process. tiktoken may download its encoding the first time.
+    """
+    global _context_packer
+    if _context_packer is None:
+        _context_packer = ContextPacker(LLM_MODEL_INFO["model_name"], budget=CONTEXT_TOKEN_BUDGET)
+    return _context_packer
+
+
+# A model container M_search, one per document in the registry.
 # M_search affects what the user is shown
 # by modeling similarity between chunks of text in 1 to N PDFs.
-# M_search uses sklearn.neighbors.NearestNeighbors over sentence-transformers embeddings.
+# M_search uses a nearest neighbor index (workflows/nn_index.py) over sentence-transformers embeddings.
 class SemanticSearchModel:
     """
     Manager for a semantic search model.
@@ -71,22 +173,57 @@ class SemanticSearchModel:
             to give the LLM a boost.
 
     args:
-        None
+        embedding_model: SentenceTransformer or OnnxEncoder
+            Defaults to the process-wide model from get_embedding_model().
+        embedding_cache: EmbeddingCache
+            Defaults to the process-wide cache from get_embedding_cache().
+        index_backend: str
+            Nearest neighbor backend, "exact", "hnsw" or "ivf".
+        index_params: Dict
+            Build and query parameters for the backend, e.g. {"ef_search": 128},
+            or {"storage": "int8", "rescore_factor": 4} for a quantized exact index.
+        hybrid_params: Dict
+            When given, queries go through a BM25 prefilter and a dense rerank of its candidates,
+            e.g. {"n_candidates": 200, "fusion": "rrf"}. Defaults to HYBRID_PARAMS.
 
     methods:
         fit(data: List[str], batch: int, n_neighbors: int) -> None:
             Fits the model M with the data.
+        fit_stream(buffer: ChunkBuffer, chunk_ids: Iterable[int], batch: int, n_neighbors: int) -> List[int]:
+            Fits the model M while chunks are still being produced. Returns the page of each chunk.
+        save(store: IndexStore, key: str, pages: List[int]) -> None:
+            Persists the embeddings and data of a fitted model.
+        load(store: IndexStore, key: str, n_neighbors: int) -> None:
+            Memory-maps a saved model back in, without re-encoding.
+        search_batch(queries: List[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+            Returns (indices, scores) of the k nearest chunks of every query, scores being cosine similarity.
         _get_text_embedding(texts: List[str], batch: int) -> np.ndarray:
             Returns the embeddings of the text.
     """
 
-    def __init__(self):
-        self.embedding_model = SentenceTransformer(
-            TEXT_EMBEDDING_MODEL_INFO["model_name"]
-        )
+    def __init__(
+        self,
+        embedding_model=None,
+        embedding_cache=None,
+        index_backend=INDEX_BACKEND,
+        index_params=None,
+        hybrid_params=None,
+    ):
+        self.embedding_model = embedding_model or get_embedding_model()
+        self.embedding_cache = embedding_cache or get_embedding_cache()
+        self.index_backend = index_backend
+        self.index_params = INDEX_PARAMS if index_params is None else index_params
+        self.hybrid_params = HYBRID_PARAMS if hybrid_params is None else hybrid_params
         self.fitted = False
 
-    def _get_text_embedding(self, texts, batch_size=DEFAULT_BATCH_SIZE):
+    def _encode(self, texts):
+        if self.embedding_cache is None:
+            return self.embedding_model.encode(texts)
+        return self.embedding_cache.encode(texts, self.embedding_model.encode)
+
+    def _get_text_embedding(
+        self, texts, batch_size=DEFAULT_BATCH_SIZE, progress=no_progress
+    ):
         """
         Gather a stack of embedded texts, packed batch_size at a time.
         """
@@ -94,45 +231,228 @@ class SemanticSearchModel:
         n_texts = len(texts)
         for batch_start_idx in range(0, n_texts, batch_size):
             text_batch = texts[batch_start_idx : (batch_start_idx + batch_size)]
-            embedding_batch = self.embedding_model.encode(text_batch)
+            embedding_batch = self._encode(text_batch)
             embeddings.append(embedding_batch)
+            progress(
+                "chunks_embedded",
+                n_embedded=batch_start_idx + len(text_batch),
+                n_chunks=n_texts,
+            )
         print("[DEBUG] Embedding batches:", len(embeddings))
         embeddings = np.vstack(embeddings)
         print("[DEBUG] Embedding reshaped:", embeddings.shape)
         return embeddings
 
-    def fit(self, data, batch_size=DEFAULT_BATCH_SIZE, n_neighbors=DEFAULT_N_NEIGHBORS):
+    def fit(
+        self,
+        data,
+        batch_size=DEFAULT_BATCH_SIZE,
+        n_neighbors=DEFAULT_N_NEIGHBORS,
+        progress=no_progress,
+    ):
         """
         Fit the model conditioned on nearest neighbors in sentence-transformers embedding space of a PDF.
         """
         self.data = data
-        self.embeddings = self._get_text_embedding(data, batch_size=batch_size)
-        n_neighbors = min(n_neighbors, len(self.embeddings))
+        self.embeddings = self._get_text_embedding(
+            data, batch_size=batch_size, progress=progress
+        )
+        self._fit_nn(n_neighbors)
+
+    def fit_stream(
+        self,
+        buffer,
+        chunk_ids,
+        batch_size=DEFAULT_STREAM_BATCH_SIZE,
+        n_neighbors=DEFAULT_N_NEIGHBORS,
+        progress=no_progress,
+    ):
+        """
+        Fit the model from chunk ids over a ChunkBuffer, as yielded by iter_chunk_spans over iter_pdf_pages.
+        Chunks are encoded in fixed-size batches as they arrive, so encoding overlaps with extraction
+        running ahead in the page extraction processes, and no full list of pages is ever built.
+        The buffer becomes self.data, so chunk strings are only rendered when retrieved.
+        """
+        self.data, embeddings = buffer, []
+        batch = []
+        for i in chunk_ids:
+            batch.append(i)
+            if len(batch) == batch_size:
+                embeddings.append(self._encode_chunks(buffer, batch, progress))
+                batch = []
+        # The chunk iterator is exhausted, so extraction is done; only the last batch is left.
+        progress("pages_extracted", n_pages=buffer.page(len(buffer) - 1) if len(buffer) else 0)
+        if batch:
+            embeddings.append(self._encode_chunks(buffer, batch, progress))
+        print("[DEBUG] Embedding batches:", len(embeddings))
+        self.embeddings = np.vstack(embeddings)
+        print("[DEBUG] Embedding reshaped:", self.embeddings.shape)
+        self._fit_nn(n_neighbors)
+        return buffer.pages
+
+    def _encode_chunks(self, buffer, batch, progress):
+        embedding_batch = self._encode([buffer[i] for i in batch])
+        progress("chunks_embedded", n_embedded=batch[-1] + 1, page=buffer.page(batch[-1]))
+        return embedding_batch
+
+    def _fit_nn(self, n_neighbors):
+        self.n_neighbors = min(n_neighbors, len(self.embeddings))
         print(
-            "[DEBUG] Fitting Nearest Neighbors model with %s neighbors." % n_neighbors
+            "[DEBUG] Fitting %s Nearest Neighbors model with %s neighbors."
+            % (self.index_backend, self.n_neighbors)
         )
-        self.nn = NearestNeighbors(n_neighbors=n_neighbors)
-        self.nn.fit(self.embeddings)
+        self.nn = make_index(
+            self.index_backend, n_neighbors=self.n_neighbors, **self.index_params
+        ).build(self.embeddings)
+        self.hybrid = None
+        if self.hybrid_params:
+            self.hybrid = HybridSearch(**self.hybrid_params).build(
+                self.texts(range(len(self.data)))
+            )
         print("[DEBUG] Fit complete.")
         self.fitted = True
 
+    def save(self, store, key, pages=None):
+        """
+        Persist the model, then swap the in-memory embedding matrix for the memory-mapped file.
+        With a quantized index (index_params {"storage": "int8"}) only the codes stay resident;
+        the float32 vectors used for exact rescoring are paged in from disk on demand.
+        """
+        store.save(key, self.embeddings, self.data, pages=pages)
+        self.embeddings = store.load_embeddings(key)
+        if hasattr(self.nn, "attach_vectors"):
+            self.nn.attach_vectors(self.embeddings)
+
+    def load(self, store, key, n_neighbors=DEFAULT_N_NEIGHBORS):
+        """
+        Restore a model saved with save(). The embedding matrix stays memory-mapped.
+        """
+        self.embeddings, metadata = store.load(key)
+        self.data = metadata["chunks"]
+        self._fit_nn(n_neighbors)
+        return metadata
+
     def __call__(self, text, return_data=True):
         """
         Inference time method.
         Return the nearest neighbors of a new text.
         """
         print("[DEBUG] Getting nearest neighbors of text:", text)
-        embedding = self.embedding_model.encode([text])
+        embedding = self._encode_query(text)
         print("[DEBUG] Embedding:", embedding.shape)
-        neighbors = self.nn.kneighbors(embedding, return_distance=False)[0]
+        neighbors = self._search([text], embedding, self.n_neighbors)[0][0]
+        # Approximate backends pad with -1 when they find fewer than k candidates.
+        neighbors = neighbors[neighbors >= 0]
         if return_data:
             return [self.data[text_neighbs] for text_neighbs in neighbors]
         else:
             return neighbors
 
+    def search_batch(self, queries, k=DEFAULT_N_NEIGHBORS, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Encode all queries in one batch and search them together. For evaluations and batch Q&A.
+        """
+        queries = list(queries)
+        embeddings = self.embedding_model.encode(queries, batch_size=batch_size)
+        return self._search(queries, embeddings, k)
+
+    def _search(self, queries, embeddings, k):
+        if self.hybrid is None:
+            return self.nn.search(embeddings, k)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, embedding) in enumerate(zip(queries, embeddings)):
+            ids, fused = self.hybrid.search(query, embedding, self.embeddings, self.nn, k)
+            indices[i, : len(ids)] = ids
+            scores[i, : len(ids)] = fused
+        return indices, scores
+
+    def _encode_query(self, text):
+        key = (EMBEDDING_MODEL_KEY, " ".join(text.split()))
+        embedding = query_embedding_cache.get(key)
+        if embedding is None:
+            embedding = self.embedding_model.encode([text])
+            embedding.setflags(write=False)
+            query_embedding_cache.set(key, embedding)
+        return embedding
+
+    def texts(self, ids):
+        """
+        Chunks without their citation prefix, from the ChunkBuffer or from loaded rendered chunks.
+        """
+        if hasattr(self.data, "text"):
+            return [self.data.text(i) for i in ids]
+        return [strip_citation(self.data[i]) for i in ids]
+
+
+registry = IndexRegistry(max_bytes=INDEX_REGISTRY_MAX_BYTES)
+index_store = IndexStore(model_name=EMBEDDING_MODEL_KEY)
+jobs = JobManager(max_workers=INGESTION_WORKERS)
+summary_cache = TTLCache(maxsize=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL)
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+# Uploads with background=true return a job right away; jobs run pdf_to_rag as asyncio tasks.
+# Each uploaded PDF gets its own M_search, looked up by doc_id.
 
-M_search = SemanticSearchModel()
-# M_search is used in routes as a Python global variable. 😬
+
+def retrieve_context(M_search, question):
+    """
+    Nearest chunks to the question, deduplicated and packed into CONTEXT_TOKEN_BUDGET in relevance order.
+    """
+    neighbors = M_search(question, return_data=False)  # RAG🌶️
+    chunks = [M_search.data[i] for i in neighbors]
+    return get_context_packer().pack(chunks, texts=M_search.texts(neighbors))
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """
+    Run blocking or CPU-heavy work on the bounded cpu_executor, so the event loop keeps serving requests.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(cpu_executor, functools.partial(fn, *args, **kwargs))
+
+
+def _warmup_embedding_model():
+    # The first encode call allocates buffers and, on ONNX Runtime, optimizes the graph.
+    get_embedding_model().encode(["warmup"])
+
+
+def _warmup_pdf_executor():
+    # Spawned workers import pdf_utils and fitz on their first task, not when the pool is created.
+    executor = get_pdf_executor()
+    if executor is not None:
+        list(executor.map(warm_pdf_worker, range(PDF_WORKERS)))
+
+
+async def warmup(report):
+    """
+    Load every heavy resource before the replica reports ready, so no user request pays for a cold start.
+    Run from the app lifespan; phase timings and failures go to report.
+    """
+    phases = [
+        ("openai client", get_openai_client),
+        ("embedding model", _warmup_embedding_model),
+        ("embedding cache", get_embedding_cache),
+        ("context packer", get_context_packer),
+        ("pdf workers", _warmup_pdf_executor),
+    ]
+    try:
+        for name, fn in phases:
+            with report.phase(f"warmup {name}"):
+                await run_blocking(fn)
+    except Exception as e:
+        report.error = f"{type(e).__name__}: {e}"
+        print(f"[ERROR] Warmup failed: {report.error}")
+        return
+    report.ready = True
+
+
+async def shutdown():
+    jobs.shutdown()
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+    if _pdf_executor is not None:
+        _pdf_executor.shutdown(wait=False, cancel_futures=True)
+    if _embedding_cache is not None:
+        _embedding_cache.close()
 
 
 # @router.post("/return-fit-chart")
@@ -151,6 +471,8 @@ async def upload_url_from_file_list(text_ls: str):
     """
     Run a Metaflow workflow to download PDFs from a list of URLs.
     """
+    from metaflow import Runner, Flow
+
     print("[INFO] Received: ", text_ls)
     filename = "pdfList.txt"
     with open(filename, "w") as f:
@@ -162,20 +484,17 @@ async def upload_url_from_file_list(text_ls: str):
     with open(filename, "r") as f:
         print("[INFO] Reading from file." + f.read())
 
-    with Runner("workflows/pdf_batch_flow.py").run(
+    with await Runner("workflows/pdf_batch_flow.py").async_run(
         url_list=filename
     ) as running:
-        import time
-
         while running.status == "running":
-            time.sleep(3)
+            await asyncio.sleep(3)
         print(f"{running.run} finished")
         print(f"Run status is {running.status}")
 
         if running.status == "successful":
-            global M_search
-            flow = Flow(FLOW_NAME)
-            run = flow.latest_successful_run
+            # The client API calls the metadata service synchronously.
+            run = await run_blocking(lambda: Flow(FLOW_NAME).latest_successful_run)
             # M_search = run.data.model
             # json_content = run.data.chart_json
             return {"message": f"Metaflow run {FLOW_NAME}/{run.id} finished."}
@@ -183,67 +502,125 @@ async def upload_url_from_file_list(text_ls: str):
             return {"message": "ERROR. Metaflow workflow failed."}
 
 
-@router.post("/upload-pdf-url")
-async def upload_pdf_from_url(url: str, name: str):
+async def download_pdf(url, save_path):
+    """
+    Stream url to save_path. The body goes to a temporary file renamed into place,
+    so a failed download never leaves a truncated PDF to be indexed; the error is raised.
+    """
+    tmp_path = f"{save_path}.part"
+    try:
+        async with httpx.AsyncClient(
+            follow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+        ) as client:
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as file:
+                    async for block in response.aiter_bytes():
+                        file.write(block)
+        os.replace(tmp_path, save_path)
+    except httpx.HTTPError as e:
+        print(f"Failed to download PDF: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    print(f"PDF downloaded successfully and saved to {save_path}")
+
+
+async def url_to_rag(url, pdf_file_path, progress=no_progress):
+    await download_pdf(url, pdf_file_path)
+    progress("downloaded", url=url)
+    return await pdf_to_rag(pdf_file_path, progress=progress)
+
+
+def upload_path(name):
+    """
+    A path under data/ that no other upload gets. Uploads are queued as jobs,
+    so two uploads of the same file name must not overwrite each other before they are read.
+    """
+    if not os.path.exists("data"):
+        os.makedirs("data")
+    return f"data/{uuid.uuid4().hex}-{os.path.basename(name)}"
 
-    def download_pdf(url, save_path):
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            with open(save_path, "wb") as file:
-                file.write(response.content)
-            print(f"PDF downloaded successfully and saved to {save_path}")
-        except requests.exceptions.RequestException as e:
-            print(f"Failed to download PDF: {e}")
+
+def write_bytes(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+@router.post("/upload-pdf-url")
+async def upload_pdf_from_url(url: str, name: str, background: bool = False):
+    """
+    With background=true, return an ingestion job right away instead of the summary.
+    Follow it with /jobs/{job_id} or /jobs/{job_id}/events.
+    """
 
     # Download the PDF file.
-    pdf_file_path = f'data/{name.strip().replace(" ", "_")}.pdf'
-    if not os.path.exists("data"):
-        os.makedirs("data")
-    download_pdf(url, pdf_file_path)
-    return pdf_to_rag(pdf_file_path)
+    pdf_file_path = upload_path(f'{name.strip().replace(" ", "_")}.pdf')
+    if background:
+        return jobs.submit(url_to_rag, url, pdf_file_path, source=url).to_dict()
+    try:
+        return await url_to_rag(url, pdf_file_path)
+    except httpx.HTTPError as e:
+        return JSONResponse(
+            content={"message": f"ERROR. Failed to download PDF: {e}"}, status_code=502
+        )
 
 
 @router.post("/upload-pdf-file")
-async def upload_pdf_from_file(uf: UploadFile):
+async def upload_pdf_from_file(uf: UploadFile, background: bool = False):
     """
     UploadFile request makes a spooled file.
     It does a kind of buffering, storing the file in memory to a size, then store it on disk.
     Read more: https://fastapi.tiangolo.com/tutorial/request-files/#file-parameters-with-uploadfile
+
+    With background=true, return an ingestion job right away instead of the summary.
     """
 
     print("[INFO] Received: ", uf.filename)
     if uf.content_type != "application/pdf":
         return {"Error": "Only PDF files are allowed!"}
-    pdf_file_path = f"data/{uf.filename}"
-    if not os.path.exists("data"):
-        os.makedirs("data")
-    pdf_bytes = uf.file.read()
-    
-    with open(pdf_file_path, "wb") as f:
-        f.write(pdf_bytes)
+    pdf_file_path = upload_path(uf.filename)
+    pdf_bytes = await uf.read()
+    await run_blocking(write_bytes, pdf_file_path, pdf_bytes)
+
+    if background:
+        return jobs.submit(pdf_to_rag, pdf_file_path, source=uf.filename).to_dict()
+    return await pdf_to_rag(pdf_file_path)
+
 
-    return pdf_to_rag(pdf_file_path)
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(content={"message": "ERROR. Unknown job."}, status_code=404)
+    return job.to_dict()
 
 
-def pdf_to_rag(pdf_file_path):
+@router.get("/jobs/{job_id}/events")
+async def stream_job(job_id: str):
+    """
+    Server-sent events with per-stage progress of an ingestion job.
+    The final "done" event carries the job, including the summary as its result.
+    """
+    return StreamingResponse(jobs.stream(job_id), media_type="text/event-stream")
+
+
+async def pdf_to_rag(pdf_file_path, progress=no_progress):
 
     print("[INFO] Processing PDF: ", pdf_file_path)
-    process_pdf(pdf_file_path)
-    # Have now created the RAG+LLM inputs, including setting M_search.
-    global M_search
-    if M_search is None:
-        return {
-            "message": "ERROR. PDF upload isn't working because M_search hasn't been set."
-        }
+    doc_index = await run_blocking(process_pdf, pdf_file_path, progress=progress)
+    # Have now created the RAG+LLM inputs, including fitting M_search.
+    summary_key = (doc_index.doc_id, LLM_MODEL_INFO["model_name"], SUMMARY_PROMPT_VERSION)
+    out = summary_cache.get(summary_key)
+    if out is not None:
+        print("[INFO] Reusing summary for document:", doc_index.doc_id)
+        progress("summary_ready", cached=True)
+        return dict(out)
+    M_search = doc_index.model
     print("[INFO] Organizing prompt...")
-    prompt = ""
-    prompt += "search results:\n\n"
-    # TODO: Add a check for the prompt length, depending on model.
     question = "What are the key points of the document?"
-    topn_chunks = M_search(question)  # RAG🌶️
-    for similar_chunk in topn_chunks:
-        prompt += similar_chunk + "\n\n"
+    packed = await run_blocking(retrieve_context, M_search, question)
+    prompt = packed.render()
     message_history = [
         {
             "role": "system",
@@ -262,29 +639,67 @@ def pdf_to_rag(pdf_file_path):
         },
     ]
     # print("[INFO] Sending request to OpenAI.", message_history)
-    completion = oai_compatible_client.chat.completions.create(
+    completion = await get_openai_client().chat.completions.create(
         model=LLM_MODEL_INFO["model_name"],
         messages=message_history,
         response_format={"type": "json_object"},
     )
     out_json = completion.choices[0].message.content
+    progress("summary_ready")
     # TODO: Postprocessing.
-    return json.loads(out_json)
+    out = json.loads(out_json)
+    out["doc_id"] = doc_index.doc_id
+    out["context_tokens"] = packed.n_tokens
+    summary_cache.set(summary_key, dict(out))
+    return out
 
 
-@router.get("/pdf-chat")
-async def pdf_chat(question: str, ctx_messages: str):
+def load_document(doc_id):
+    """
+    The registry's index for doc_id, else the one saved in the index store, memory-mapped back in
+    and added to the registry, e.g. after a restart or an eviction. None if neither has it.
+    Blocking.
+    """
+    doc_index = registry.get(doc_id)
+    if doc_index is not None or doc_id not in index_store:
+        return doc_index
+    print("[INFO] Loading saved index for document:", doc_id)
+    M_search = SemanticSearchModel()
+    M_search.load(index_store, doc_id)
+    doc_index = DocumentIndex(doc_id, M_search)
+    registry.put(doc_index)
+    return doc_index
+
+
+async def get_document(doc_id):
+    """
+    (doc_index, None) for a known doc_id, else (None, error response).
+    There is no default document: it would be whichever one another user touched last.
+    """
+    if doc_id is None:
+        return None, JSONResponse(
+            content={"message": "ERROR. doc_id is required, as returned by the upload routes."},
+            status_code=400,
+        )
+    doc_index = await run_blocking(load_document, doc_id)
+    if doc_index is None:
+        return None, JSONResponse(
+            content={"message": "ERROR. Unknown doc_id, upload the PDF file again."},
+            status_code=404,
+        )
+    return doc_index, None
+
 
-    global M_search
-    if M_search is None:
-        return {"message": "ERROR. Upload a PDF file before chatting."}
+async def chat_messages(doc_index, question, ctx_messages):
+    """
+    Retrieve the chunks of the document nearest to the question and build the chat prompt.
+    Returns the messages and the PackedContext, to report the tokens used.
+    """
+    M_search = doc_index.model
 
     ctx_messages = json.loads(ctx_messages)
-    prompt = ""
-    prompt += "search results:\n\n"
-    topn_chunks = M_search(question)
-    for c in topn_chunks:
-        prompt += c + "\n\n"
+    packed = await run_blocking(retrieve_context, M_search, question)
+    prompt = packed.render()
     message_history = [
         {
             "role": "system",
@@ -317,11 +732,23 @@ async def pdf_chat(question: str, ctx_messages: str):
             "content": prompt,
         },
     ]
+    return message_history, packed
+
+
+@router.get("/pdf-chat")
+async def pdf_chat(question: str, ctx_messages: str, doc_id: Optional[str] = None):
+    """
+    Chat with the PDF identified by doc_id, as returned by the upload routes.
+    """
+
+    doc_index, error = await get_document(doc_id)
+    if error is not None:
+        return error
+    message_history, packed = await chat_messages(doc_index, question, ctx_messages)
 
-    # TODO: Add a check for the prompt length, depending on model.
     # TODO: Content moderation. Flag PII.
 
-    completion = oai_compatible_client.chat.completions.create(
+    completion = await get_openai_client().chat.completions.create(
         model=LLM_MODEL_INFO["model_name"],
         messages=message_history,
         response_format={"type": "json_object"},
@@ -330,88 +757,82 @@ async def pdf_chat(question: str, ctx_messages: str):
 
     # TODO: Log request/response/and stuff in a to-be-eval'd DB.
 
-    return json.loads(out_json)
+    out = json.loads(out_json)
+    out["context_tokens"] = packed.n_tokens
+    return out
 
 
-def process_pdf(pdf_file_path):
+@router.get("/pdf-chat-stream")
+async def pdf_chat_stream(
+    question: str, ctx_messages: str, doc_id: Optional[str] = None
+):
     """
-    This function processes the PDF file and prepares the data for the LLM.
-    It is called pretty soon after the user uploads a PDF file.
-
-    Extract text from the PDF file.
-    Split the text into chunks.
-    **Side effect**: store chunks. Fit new M_search. Set text_ls and chunks too based on new PDF.
-    Make a new SemanticSearchModel model, put it in M_search and fit it with the chunks.
+    Streaming variant of /pdf-chat, as server-sent events.
+    "token" events carry the answer text as the LLM generates it.
+    The final "done" event carries the parsed JSON, with citations and answer, like /pdf-chat returns.
     """
-    global M_search, text_ls, chunks
-    # TODO part 1: user has been waiting since request gets to API server.
-    text_ls = pdf_to_text(pdf_file_path)
-    chunks = text_to_chunks(text_ls)
-    M_search.fit([c[0] for c in chunks])
-    # TODO part 2: now loading screen stops for user.
-    return chunks
 
+    doc_index, error = await get_document(doc_id)
+    if error is not None:
+        return error
+    message_history, packed = await chat_messages(doc_index, question, ctx_messages)
+
+    async def events():
+        stream = await get_openai_client().chat.completions.create(
+            model=LLM_MODEL_INFO["model_name"],
+            messages=message_history,
+            response_format={"type": "json_object"},
+            stream=True,
+        )
+        answer = JsonFieldStreamer("answer")
+        async for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            token = answer.feed(chunk.choices[0].delta.content)
+            if token:
+                yield sse_event("token", {"token": token})
+        try:
+            out = json.loads(answer.buffer)
+        except json.JSONDecodeError:
+            out = {"message": "ERROR. LLM response is not valid JSON.", "raw": answer.buffer}
+        out["context_tokens"] = packed.n_tokens
+        yield sse_event("done", out)
 
-################################################################
-# Following is based on this repo:
-# https://github.com/bhaskatripathi/pdfGPT/blob/main/api.py#L105
-################################################################
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
-def preprocess(text):
-    """
-    Apply rules to process one string of text that is extracted from a PDF.
+def process_pdf(pdf_file_path, progress=no_progress):
     """
-    text = text.replace("\n", " ")
-    text = re.sub(r"\s+", " ", text)
-    return text
-
+    This function processes the PDF file and prepares the data for the LLM.
+    It is called pretty soon after the user uploads a PDF file.
+    It blocks, so async routes call it through run_blocking.
 
-def pdf_to_text(path, start_page=1, end_page=None):
-    """
-    Extracts text from a PDF file and preprocesses it.
+    Extract text from the PDF file.
+    Split the text into chunks.
+    Make a new SemanticSearchModel model, fit it with the chunks as they are produced,
+    and store it in the registry under the content hash of the PDF.
+    If the registry already holds this PDF, reuse it instead.
+    If the index store on disk has it, memory-map it back in instead of re-encoding.
     """
-    doc = fitz.open(path)
-    total_pages = doc.page_count
-    if end_page is None:
-        end_page = total_pages
-    text_list = []
-    for i in range(start_page - 1, end_page):
-        text = doc.load_page(i).get_text("text")
-        text = preprocess(text)
-        text_list.append({"content": text, "page": i + 1})
-    doc.close()
-    return text_list
-
+    doc_id = content_hash(pdf_file_path)
+    doc_index = load_document(doc_id)
+    if doc_index is not None:
+        print("[INFO] Reusing index for document:", doc_id)
+        progress("index_ready", doc_id=doc_id, n_chunks=doc_index.n_chunks)
+        return doc_index
+    # Extract -> chunk -> embed is one pipeline: pages stream out of the extraction processes,
+    # chunks are cut as spans over the page strings as pages arrive,
+    # and chunks are embedded a batch at a time.
+    M_search = SemanticSearchModel()
+    page_iter = iter_pdf_pages(
+        pdf_file_path, n_workers=PDF_WORKERS, executor=get_pdf_executor()
+    )
+    buffer = ChunkBuffer()
+    chunk_ids = iter_chunk_spans(page_iter, buffer, word_length=DEFAULT_WORD_LENGTH)
+    pages = M_search.fit_stream(buffer, chunk_ids, progress=progress)
+    M_search.save(index_store, doc_id, pages=pages)
+    doc_index = DocumentIndex(doc_id, M_search, source=pdf_file_path)
+    registry.put(doc_index)
+    progress("index_ready", doc_id=doc_id, n_chunks=doc_index.n_chunks)
+    return doc_index
 
-def text_to_chunks(
-    texts,  # list of Dict[Tuple] like {'content'='', 'page': int})
-    word_length=DEFAULT_WORD_LENGTH,
-    start_page=1,
-):
-    text_toks = [(t["content"].split(" "), t["page"]) for t in texts]
-    text_toks_len = len(text_toks)
-    chunks = []
-    for token_idx, words_and_page in enumerate(text_toks):
-        words = words_and_page[0]
-        n_words = len(words)
-        page = words_and_page[1]
-        for i in range(0, n_words, word_length):
-            chunk = words[i : i + word_length]
-            chunk_sz = len(chunk)
-            if (
-                (i + word_length) > n_words
-                and (chunk_sz < word_length)
-                and (text_toks_len != (token_idx + 1))
-            ):
-                text_toks[token_idx + 1] = (
-                    chunk + text_toks[token_idx + 1][0],
-                    text_toks[token_idx + 1][1],
-                )
-                continue
-            chunk_join = " ".join(chunk).strip()
-            # TODO: Improve way to add page number citation.
-            # Rely less on LLM to do citation through token generation, maybe 🤨.
-            chunk = f"[Page no. {token_idx+start_page}]" + " " + '"' + chunk_join + '"'
-            chunks.append((chunk, page))
-    return chunks
@@ -0,0 +1,43 @@
+import time
+from contextlib import contextmanager
+
+
+class StartupReport:
+    """
+    Wall time of each startup phase: module imports, then the warmup of heavy resources.
+    Served by /readyz, so a slow cold start can be attributed without attaching a profiler.
+
+    attributes:
+        phases: Dict[str, float]
+            Seconds spent in each phase, in the order they ran.
+        ready: bool
+            True once warmup has finished; the replica should not get traffic before.
+        error: str
+            Why warmup failed, if it did.
+    """
+
+    def __init__(self):
+        self.created_at = time.perf_counter()
+        self.phases = {}
+        self.ready = False
+        self.error = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.perf_counter() - start, 3)
+            print(f"[INFO] Startup: {name} took {self.phases[name]:.3f}s.")
+
+    def to_dict(self):
+        return {
+            "ready": self.ready,
+            "error": self.error,
+            "uptime_s": round(time.perf_counter() - self.created_at, 3),
+            "phases": dict(self.phases),
+        }
+
+
+startup_report = StartupReport()
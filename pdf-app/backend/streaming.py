@@ -0,0 +1,66 @@
+import re
+import json
+
+
+JSON_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "b": "\b", "f": "\f"}
+
+
+def sse_event(event, data):
+    """
+    Format one server-sent event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class JsonFieldStreamer:
+    """
+    Pull the value of one string field out of a JSON object while the LLM is still generating it.
+    Feed it the raw completion deltas; it returns the newly decoded characters of the field, if any.
+
+    args:
+        field: str
+            Name of the string field to stream, e.g. "answer".
+    """
+
+    def __init__(self, field):
+        self.pattern = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self.buffer = ""
+        self.pos = None  # Where the undecoded part of the value starts in buffer.
+        self.done = False
+
+    def feed(self, text):
+        self.buffer += text
+        if self.done:
+            return ""
+        if self.pos is None:
+            match = self.pattern.search(self.buffer)
+            if match is None:
+                return ""
+            self.pos = match.end()
+
+        out = []
+        i, n = self.pos, len(self.buffer)
+        while i < n:
+            c = self.buffer[i]
+            if c == "\\":
+                # Wait for the rest of an escape sequence split across deltas.
+                if i + 1 >= n:
+                    break
+                escaped = self.buffer[i + 1]
+                if escaped == "u":
+                    if i + 6 > n:
+                        break
+                    out.append(chr(int(self.buffer[i + 2 : i + 6], 16)))
+                    i += 6
+                    continue
+                out.append(JSON_ESCAPES.get(escaped, escaped))
+                i += 2
+                continue
+            if c == '"':
+                self.done = True
+                i += 1
+                break
+            out.append(c)
+            i += 1
+        self.pos = i
+        return "".join(out)
@@ -0,0 +1,103 @@
+"""
+Compare recall and query latency of the nearest neighbor index backends.
+
+    python benchmark_index.py --n 200000
+    python benchmark_index.py --embeddings ../data/index/all-MiniLM-L6-v2/<key>/embeddings.npy
+    python benchmark_index.py --backends exact ivf --params '{"ivf": {"n_probe": 16}}'
+
+Recall@k is measured against the exact backend on the same queries.
+"""
+
+import time
+import json
+import argparse
+import numpy as np
+
+from nn_index import make_index, normalize
+
+
+def synthetic_embeddings(n, dim=384, n_clusters=200, seed=0):
+    """
+    Clustered unit vectors, closer to real chunk embeddings than uniform noise.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    labels = rng.integers(n_clusters, size=n)
+    return normalize(centers[labels] + 0.5 * rng.normal(size=(n, dim)))
+
+
+def benchmark(embeddings, backends, k=8, n_queries=1000, params=None, seed=1):
+    params = params or {}
+    rng = np.random.default_rng(seed)
+    # Perturbed copies of indexed vectors, so queries have real neighbors.
+    rows = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+    queries = normalize(embeddings[rows] + 0.05 * rng.normal(size=(len(rows), embeddings.shape[1])))
+
+    results = []
+    truth = None
+    for backend in ["exact"] + [b for b in backends if b != "exact"]:
+        start = time.perf_counter()
+        index = make_index(backend, n_neighbors=k, **params.get(backend, {})).build(embeddings)
+        build_s = time.perf_counter() - start
+
+        latencies = []
+        found = []
+        for q in queries:
+            start = time.perf_counter()
+            indices, _ = index.search(q[None, :], k)
+            latencies.append(time.perf_counter() - start)
+            found.append(indices[0])
+        found = np.array(found)
+        if truth is None:
+            truth = found
+        recall = np.mean(
+            [len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)]
+        )
+        if backend in backends:
+            results.append(
+                {
+                    "backend": backend,
+                    "build_s": build_s,
+                    "p50_ms": 1000 * np.percentile(latencies, 50),
+                    "p99_ms": 1000 * np.percentile(latencies, 99),
+                    f"recall@{k}": recall,
+                }
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--embeddings", help="A .npy embedding matrix. Synthetic data if not given.")
+    parser.add_argument("--n", type=int, default=100_000, help="Synthetic vectors.")
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--backends", nargs="+", default=["exact", "ivf", "hnsw"])
+    parser.add_argument("--params", default="{}", help="JSON of per-backend constructor params.")
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = normalize(np.load(args.embeddings, mmap_mode="r"))
+    else:
+        embeddings = synthetic_embeddings(args.n)
+    print(f"[INFO] {len(embeddings)} vectors of dim {embeddings.shape[1]}, {args.queries} queries.")
+
+    results = benchmark(
+        embeddings,
+        args.backends,
+        k=args.k,
+        n_queries=args.queries,
+        params=json.loads(args.params),
+    )
+    header = list(results[0])
+    print(" | ".join(f"{h:>10}" for h in header))
+    for r in results:
+        print(
+            " | ".join(
+                f"{v:>10.3f}" if isinstance(v, float) else f"{v:>10}" for v in r.values()
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
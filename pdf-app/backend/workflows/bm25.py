@@ -0,0 +1,192 @@
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+
+try:
+    from nn_index import normalize
+except ImportError:
+    # Imported as workflows.bm25 by the API, rather than from the flow's directory.
+    from .nn_index import normalize
+
+
+# Words, plus compounds joined by - . / so part numbers (AB-1234) and clause ids (4.2.1)
+# are matched whole, on top of their parts.
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./]\w+)*")
+WORD_PATTERN = re.compile(r"\w+")
+FUSIONS = ("rrf", "linear", "dense")
+
+
+def tokenize(text):
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        tokens.append(token)
+        if not token.isalnum():
+            tokens.extend(WORD_PATTERN.findall(token))
+    return tokens
+
+
+class BM25Index:
+    """
+    Inverted index with Okapi BM25 scoring.
+    Postings are append-only arrays of (chunk id, term frequency) per term,
+    so add() only tokenizes the new chunks, and a query only touches the postings of its terms.
+
+    args:
+        k1: float
+            Term frequency saturation.
+        b: float
+            Document length normalization.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def build(self, texts):
+        self.postings = {}
+        self.lengths = array("q")
+        self.total_length = 0
+        return self.add(texts)
+
+    def add(self, texts):
+        for text in texts:
+            doc = len(self.lengths)
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                docs_tfs = self.postings.get(term)
+                if docs_tfs is None:
+                    docs_tfs = self.postings[term] = (array("q"), array("q"))
+                docs_tfs[0].append(doc)
+                docs_tfs[1].append(tf)
+            n_tokens = sum(counts.values())
+            self.lengths.append(n_tokens)
+            self.total_length += n_tokens
+        return self
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def search(self, text, k, deleted=None):
+        """
+        Returns (ids, scores) of the k best chunks containing at least one query term, best first.
+        Chunks flagged in deleted are skipped. Fewer than k when fewer chunks match.
+        """
+        n = len(self.lengths)
+        terms = [t for t in set(tokenize(text)) if t in self.postings]
+        if not n or not terms:
+            return np.empty(0, np.int64), np.empty(0, np.float32)
+        lengths = np.frombuffer(self.lengths, dtype=np.int64)
+        norm = self.k1 * (1 - self.b + self.b * lengths / (self.total_length / n))
+
+        docs, scores = [], []
+        for term in terms:
+            term_docs, term_tfs = (np.frombuffer(a, dtype=np.int64) for a in self.postings[term])
+            idf = np.log(1 + (n - len(term_docs) + 0.5) / (len(term_docs) + 0.5))
+            docs.append(term_docs)
+            scores.append(idf * term_tfs * (self.k1 + 1) / (term_tfs + norm[term_docs]))
+        ids, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        totals = np.zeros(len(ids), dtype=np.float32)
+        np.add.at(totals, inverse, np.concatenate(scores))
+        if deleted is not None:
+            alive = ~deleted[ids]
+            ids, totals = ids[alive], totals[alive]
+        top = np.argsort(-totals, kind="stable")[:k]
+        return ids[top], totals[top]
+
+
+class HybridSearch:
+    """
+    Lexical prefilter, dense rerank: BM25 picks a bounded candidate set,
+    which is then scored against the query embedding and fused with the BM25 scores.
+    Per query cost scales with the candidates, not the corpus,
+    and exact-term queries (part numbers, clause ids) find the chunks that contain them.
+
+    args:
+        n_candidates: int
+            BM25 candidates reranked per query.
+        fusion: str
+            "rrf" (reciprocal rank fusion), "linear" (alpha * cosine + (1 - alpha) * max-scaled BM25)
+            or "dense" (cosine only, BM25 just selects candidates).
+        alpha: float
+            Weight of the dense score for linear fusion.
+        rrf_k: int
+            Rank offset for reciprocal rank fusion.
+        n_dense: int
+            Dense index results added to the candidates on every query. Queries with fewer than k
+            BM25 matches, e.g. paraphrases sharing no words with the text, always get k of them.
+        k1, b: float
+            BM25 parameters.
+    """
+
+    def __init__(
+        self, n_candidates=200, fusion="rrf", alpha=0.5, rrf_k=60, n_dense=0, k1=1.5, b=0.75
+    ):
+        if fusion not in FUSIONS:
+            raise ValueError(f"Unknown fusion {fusion}. Choose one of {FUSIONS}.")
+        self.n_candidates = n_candidates
+        self.fusion = fusion
+        self.alpha = alpha
+        self.rrf_k = rrf_k
+        self.n_dense = n_dense
+        self.bm25 = BM25Index(k1=k1, b=b)
+
+    def build(self, texts):
+        """
+        texts are the chunks without their "[Page no. N]" citation prefix,
+        which would otherwise make every page number a term of every chunk.
+        """
+        self.bm25.build(texts)
+        return self
+
+    def add(self, texts):
+        self.bm25.add(texts)
+        return self
+
+    def search(self, text, embedding, embeddings, nn, k, deleted=None):
+        """
+        Returns (ids, scores) of the k best chunks for one query, best first.
+
+        args:
+            text: str
+                The query, for BM25.
+            embedding: np.ndarray
+                The query embedding.
+            embeddings: np.ndarray
+                Chunk embeddings, row i for chunk i.
+            nn: nearest neighbor index over embeddings, for dense candidates.
+            deleted: np.ndarray
+                Optional mask of removed chunks.
+        """
+        ids, lexical = self.bm25.search(text, self.n_candidates, deleted)
+        n_dense = max(self.n_dense, k if len(ids) < k else 0)
+        if n_dense:
+            dense_ids = nn.search(np.atleast_2d(embedding), n_dense)[0][0]
+            dense_ids = dense_ids[dense_ids >= 0]
+            extra = dense_ids[~np.isin(dense_ids, ids)]
+            ids = np.concatenate([ids, extra])
+            lexical = np.concatenate([lexical, np.zeros(len(extra), dtype=np.float32)])
+        if not len(ids):
+            return ids, lexical
+
+        query = normalize(np.atleast_2d(embedding))[0]
+        dense = normalize(embeddings[ids]) @ query
+        if self.fusion == "dense":
+            scores = dense
+        elif self.fusion == "linear":
+            scale = lexical.max() if lexical.max() > 0 else 1
+            scores = self.alpha * dense + (1 - self.alpha) * lexical / scale
+        else:
+            scores = 1 / (self.rrf_k + 1 + _ranks(dense))
+            # Dense-only candidates have no lexical rank.
+            scores += np.where(lexical > 0, 1 / (self.rrf_k + 1 + _ranks(lexical)), 0)
+        top = np.argsort(-scores, kind="stable")[:k]
+        return ids[top], scores[top].astype(np.float32)
+
+
+def _ranks(scores):
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[np.argsort(-scores, kind="stable")] = np.arange(len(scores))
+    return ranks
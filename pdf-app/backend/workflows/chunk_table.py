@@ -0,0 +1,150 @@
+import os
+import tempfile
+
+import numpy as np
+
+
+COLUMNS = ("text", "page", "file")
+# Rows per Parquet row group, the unit of a row range read.
+ROW_GROUP_SIZE = 16384
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Columnar chunks need pyarrow: pip install pyarrow")
+    return pa, pq
+
+
+def chunk_table(texts, pages, files):
+    """
+    Arrow table of chunks: text, page as int32, and file dictionary-encoded,
+    i.e. an int32 code per chunk plus each file name stored once.
+    """
+    pa, _ = _pyarrow()
+    return pa.table(
+        {
+            "text": pa.array(texts, type=pa.string()),
+            "page": pa.array(pages, type=pa.int32()),
+            "file": pa.array(files, type=pa.string()).dictionary_encode(),
+        }
+    )
+
+
+def concat_chunk_tables(tables):
+    """
+    One table from shard tables, in order, with a single file dictionary.
+    """
+    pa, _ = _pyarrow()
+    tables = [t for t in tables if t is not None]
+    if not tables:
+        return chunk_table([], [], [])
+    return pa.concat_tables(tables).unify_dictionaries().combine_chunks()
+
+
+def file_codes(table):
+    """
+    (file names, int code of every row into file names).
+    """
+    column = table.column("file").combine_chunks()
+    return column.dictionary.to_pylist(), column.indices.to_numpy(zero_copy_only=False)
+
+
+def chunk_stats(table, max_files=50):
+    """
+    Summary of a chunk table for cards and logs, bounded to the max_files largest files.
+    Files in the dictionary without rows, e.g. after filtering out removed chunks, are left out.
+    """
+    import pyarrow.compute as pc
+
+    names, codes = file_codes(table)
+    counts = np.bincount(codes, minlength=len(names))
+    lengths = pc.binary_length(table.column("text")).fill_null(0).to_numpy()
+    pages = table.column("page").to_numpy()
+    per_file = []
+    order = np.argsort(-counts, kind="stable")
+    for code in order[counts[order] > 0][:max_files]:
+        file_pages = pages[codes == code]
+        per_file.append(
+            {
+                "file": names[code],
+                "chunks": int(counts[code]),
+                "pages": len(np.unique(file_pages)),
+            }
+        )
+    return {
+        "n_chunks": table.num_rows,
+        "n_files": int((counts > 0).sum()),
+        "mean_chunk_chars": float(lengths.mean()) if len(lengths) else 0.0,
+        "text_bytes": int(lengths.sum()),
+        "files": per_file,
+    }
+
+
+def write_chunks(table, path):
+    _, pq = _pyarrow()
+    pq.write_table(table, path, row_group_size=ROW_GROUP_SIZE, compression="zstd")
+    return path
+
+
+class ChunkTable:
+    """
+    Lazy reader over a chunks Parquet file: only the requested columns,
+    and the row groups of the requested rows, are read into memory.
+
+    args:
+        path: str
+            Local Parquet file written by write_chunks.
+
+    methods:
+        column(name: str) -> pa.ChunkedArray:
+            One column for all rows, e.g. "file" without any text.
+        rows(start: int, stop: int, columns: List[str]) -> pa.Table:
+            Rows [start, stop), reading only the row groups that overlap them.
+        read(columns: List[str]) -> pa.Table:
+            Whole columns, all of them by default.
+    """
+
+    def __init__(self, path):
+        _, pq = _pyarrow()
+        self.path = path
+        self.parquet = pq.ParquetFile(path)
+        sizes = [
+            self.parquet.metadata.row_group(i).num_rows
+            for i in range(self.parquet.num_row_groups)
+        ]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+
+    @classmethod
+    def from_url(cls, url, path=None):
+        """
+        Downloads a chunks file persisted by a flow run, e.g. its chunks_url artifact.
+        """
+        from metaflow import S3
+
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix=".parquet")
+            os.close(fd)
+        with S3() as s3:
+            os.rename(s3.get(url).path, path)
+        return cls(path)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def column(self, name):
+        return self.read([name]).column(name)
+
+    def read(self, columns=None):
+        return self.parquet.read(columns=columns)
+
+    def rows(self, start, stop, columns=None):
+        start, stop = max(0, start), min(stop, len(self))
+        if start >= stop:
+            return self.parquet.schema_arrow.empty_table().select(columns or list(COLUMNS))
+        first = int(np.searchsorted(self.offsets, start, side="right")) - 1
+        last = int(np.searchsorted(self.offsets, stop, side="left"))
+        table = self.parquet.read_row_groups(list(range(first, last)), columns=columns)
+        return table.slice(start - self.offsets[first], stop - start)
@@ -0,0 +1,150 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+
+DEFAULT_EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH", "data/embedding_cache.sqlite"
+)
+DEFAULT_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 200_000))
+# SQLite caps the number of host parameters in one statement.
+LOOKUP_BATCH_SIZE = 500
+
+
+def normalize_text(text):
+    """
+    Texts that differ only in whitespace share one cache entry.
+    """
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed cache of chunk embeddings, backed by one SQLite file.
+    Keys are sha256(model name, normalized text), so identical chunks are encoded once
+    no matter which PDF, file name or run they come from.
+    Bounded to max_entries; the least recently used entries are evicted first.
+
+    args:
+        model_name: str
+            Embedding model name. Part of every key.
+        path: str
+            SQLite file. Can be copied between machines, e.g. between flow runs.
+        max_entries: int
+            Upper bound on cached embeddings.
+
+    methods:
+        encode(texts: List[str], encode_fn: Callable) -> np.ndarray:
+            Returns float32 embeddings for texts in order, calling encode_fn only on misses.
+        put(texts: List[str], embeddings: np.ndarray) -> None:
+            Adds embeddings computed elsewhere, e.g. by parallel flow tasks.
+    """
+
+    def __init__(
+        self, model_name, path=DEFAULT_EMBEDDING_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES
+    ):
+        self.model_name = model_name
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)"
+        )
+        row = self._conn.execute("SELECT MAX(last_used) FROM embeddings").fetchone()
+        self._clock = row[0] or 0
+
+    def key(self, text):
+        h = hashlib.sha256()
+        h.update(self.model_name.encode())
+        h.update(b"\0")
+        h.update(normalize_text(text).encode())
+        return h.hexdigest()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def encode(self, texts, encode_fn):
+        keys = [self.key(t) for t in texts]
+        with self._lock:
+            found = self._lookup(set(keys))
+
+        # Encode each distinct missing text once, even if it repeats within texts.
+        miss_texts = {}
+        for k, t in zip(keys, texts):
+            if k not in found and k not in miss_texts:
+                miss_texts[k] = t
+        n_hits = sum(1 for k in keys if k in found)
+        self.hits += n_hits
+        self.misses += len(miss_texts)
+        print("[DEBUG] Embedding cache: %s hits, %s misses." % (n_hits, len(miss_texts)))
+        if miss_texts:
+            miss_embeddings = np.asarray(
+                encode_fn(list(miss_texts.values())), dtype=np.float32
+            )
+            new = dict(zip(miss_texts.keys(), miss_embeddings))
+            with self._lock:
+                self._insert(new)
+            found.update(new)
+
+        return np.vstack([found[k] for k in keys]) if keys else np.empty((0, 0), np.float32)
+
+    def put(self, texts, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            self._insert({self.key(t): e for t, e in zip(texts, embeddings)})
+
+    def _lookup(self, keys):
+        found = {}
+        keys = list(keys)
+        self._clock += 1
+        for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+            batch = keys[i : i + LOOKUP_BATCH_SIZE]
+            marks = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({marks})", batch
+            ).fetchall()
+            for k, blob in rows:
+                found[k] = np.frombuffer(blob, dtype=np.float32)
+            self._conn.execute(
+                f"UPDATE embeddings SET last_used = ? WHERE key IN ({marks})",
+                [self._clock, *batch],
+            )
+        self._conn.commit()
+        return found
+
+    def _insert(self, new):
+        self._clock += 1
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+            [(k, e.tobytes(), self._clock) for k, e in new.items()],
+        )
+        n_over = len(self) - self.max_entries
+        if n_over > 0:
+            # Evict a little extra so that a steady stream of misses doesn't evict on every call.
+            n_evict = n_over + self.max_entries // 10
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (n_evict,),
+            )
+            print("[DEBUG] Embedding cache evicted %s entries." % n_evict)
+        self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            # Fold the write-ahead log back in, so the single file is complete if copied.
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.close()
@@ -0,0 +1,383 @@
+"""
+Sentence embedding backends for all-MiniLM-L6-v2.
+
+    python encoders.py --quantize --threads 4
+
+exports the model to ONNX (once, cached under ONNX_MODEL_DIR), checks parity with PyTorch
+and prints the encode throughput of both.
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+DEFAULT_ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "data/onnx")
+# Padded tokens per encode call; batches of short chunks hold more texts than batches of long ones.
+DEFAULT_MAX_BATCH_TOKENS = 16_384
+DEFAULT_MAX_BATCH_SIZE = 256
+ENCODER_BACKENDS = ("torch", "onnx")
+ONNX_FILE = "model.onnx"
+QUANTIZED_ONNX_FILE = "model.int8.onnx"
+POOLING_FILE = "pooling.json"
+PARITY_TEXTS = [
+    "What is the termination clause of this contract?",
+    "[Page no. 3] \"The pump assembly AB-1234 must be inspected every 500 operating hours.\"",
+    "Revenue grew 12% year over year, driven by subscriptions.",
+    "short",
+    " ".join(["A long chunk of text that runs past the max sequence length."] * 40),
+]
+
+
+def encoder_name(model_name, backend="torch", quantize=False, **params):
+    """
+    Name to key cached embeddings and stored indexes by.
+    ONNX float32 matches PyTorch, so it shares the model's entries; int8 embeddings do not.
+    """
+    return f"{model_name}-int8" if backend == "onnx" and quantize else model_name
+
+
+def load_encoder(model_name, backend="torch", **params):
+    """
+    Make an encoder with a SentenceTransformer-compatible encode(texts, batch_size=...).
+
+    args:
+        backend: str
+            "torch" for sentence-transformers on PyTorch, "onnx" for OnnxEncoder.
+        params:
+            OnnxEncoder arguments, e.g. quantize=True, num_threads=4.
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend}. Choose one of {ENCODER_BACKENDS}.")
+    if backend == "onnx":
+        return OnnxEncoder(model_name, **params)
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    if params.get("num_threads"):
+        import torch
+
+        torch.set_num_threads(params["num_threads"])
+    return model
+
+
+def export_onnx(model_name, path, quantize=False):
+    """
+    Export the transformer of a sentence-transformers model to ONNX, with its tokenizer and pooling config.
+    Pooling and normalization run in numpy, so the exported graph is the plain encoder.
+    Needs torch, sentence-transformers and onnx; loading the export afterwards does not.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer, models
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    pooling = [m for m in model if isinstance(m, models.Pooling)]
+    if not pooling or pooling[0].get_pooling_mode_str() != "mean":
+        raise ValueError(f"Only mean pooling is supported, {model_name} uses {pooling}.")
+
+    class Encoder(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.transformer(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+            ).last_hidden_state
+
+    os.makedirs(path, exist_ok=True)
+    inputs = model.tokenizer(["export"], return_tensors="pt")
+    input_names = ["input_ids", "attention_mask", "token_type_ids"]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            Encoder(),
+            tuple(inputs[name] for name in input_names),
+            os.path.join(path, ONNX_FILE),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+    model.tokenizer.save_pretrained(path)
+    with open(os.path.join(path, POOLING_FILE), "w") as f:
+        json.dump(
+            {
+                "max_seq_length": model.max_seq_length,
+                "normalize": any(isinstance(m, models.Normalize) for m in model),
+            },
+            f,
+        )
+    if quantize:
+        quantize_onnx(path)
+    print("[DEBUG] Exported ONNX encoder:", path)
+
+
+def quantize_onnx(path):
+    """
+    Dynamic int8 quantization of the weights; activations stay float and are quantized on the fly.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(
+        os.path.join(path, ONNX_FILE),
+        os.path.join(path, QUANTIZED_ONNX_FILE),
+        weight_type=QuantType.QInt8,
+    )
+
+
+def prepare_onnx(model_name, quantize=False, model_dir=DEFAULT_ONNX_MODEL_DIR):
+    """
+    Export (and quantize) the model unless a previous run already did. Returns (directory, model file).
+    """
+    path = os.path.join(model_dir, model_name)
+    model_file = os.path.join(path, QUANTIZED_ONNX_FILE if quantize else ONNX_FILE)
+    if not os.path.exists(os.path.join(path, ONNX_FILE)):
+        export_onnx(model_name, path, quantize=quantize)
+    elif not os.path.exists(model_file):
+        quantize_onnx(path)
+    return path, model_file
+
+
+class OnnxEncoder:
+    """
+    all-MiniLM-L6-v2 on ONNX Runtime, optionally with int8 weights, as a drop-in for
+    SentenceTransformer.encode. Batches are formed from texts of similar length to cut padding,
+    and results come back in input order.
+
+    args:
+        model_name: str
+            sentence-transformers model to export on first use.
+        quantize: bool
+            Use dynamically quantized int8 weights. Roughly 2x faster again on CPU, at a small recall cost.
+        num_threads: int
+            ONNX Runtime intra-op threads. Defaults to all cores; set to the pod's CPU limit.
+        inter_op_threads: int
+            Threads running independent graph nodes in parallel.
+        model_dir: str
+            Where exports are cached, one directory per model.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        quantize=False,
+        num_threads=None,
+        inter_op_threads=1,
+        model_dir=DEFAULT_ONNX_MODEL_DIR,
+    ):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError(
+                "The onnx encoder backend needs onnxruntime. Install it with `pip install onnxruntime`."
+            )
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.quantize = quantize
+        path, model_file = prepare_onnx(model_name, quantize, model_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(
+            model_file, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        with open(os.path.join(path, POOLING_FILE)) as f:
+            pooling = json.load(f)
+        self.max_seq_length = pooling["max_seq_length"]
+        self.normalize = pooling["normalize"]
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        if isinstance(texts, str):
+            return self.encode([texts], batch_size=batch_size)[0]
+        texts = list(texts)
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        batches = [
+            self._encode_batch([texts[i] for i in order[start : start + batch_size]])
+            for start in range(0, len(texts), batch_size)
+        ]
+        if not batches:
+            return np.empty((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+        embeddings = np.empty((len(texts), batches[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.concatenate(batches)
+        return embeddings
+
+    def _encode_batch(self, texts):
+        tokens = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np",
+        )
+        feed = {k: v.astype(np.int64) for k, v in tokens.items() if k in self.input_names}
+        hidden = self.session.run(None, feed)[0]
+        mask = feed["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.normalize:
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled
+
+
+def length_batches(
+    texts, max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS, max_batch_size=DEFAULT_MAX_BATCH_SIZE
+):
+    """
+    Group texts of similar length into batches of at most max_batch_tokens padded tokens.
+    Returns lists of positions in texts. Token counts are estimated as ~4 characters per token.
+    """
+    lengths = np.array([len(t) // 4 + 2 for t in texts])
+    order = np.argsort(lengths, kind="stable")
+    batches, batch = [], []
+    for i in order:
+        # Sorted by length, so the text being added is the longest, and sets the padded width.
+        if batch and (
+            (len(batch) + 1) * lengths[i] > max_batch_tokens or len(batch) >= max_batch_size
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(int(i))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+_worker_encoder = None
+
+
+def _init_worker(model_name, backend, params):
+    global _worker_encoder
+    # Each worker is one process with its own model copy; tokenizer threads would only oversubscribe.
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if params.get("num_threads"):
+        os.environ["OMP_NUM_THREADS"] = str(params["num_threads"])
+    _worker_encoder = load_encoder(model_name, backend, **params)
+
+
+def _encode_in_worker(texts):
+    return np.asarray(_worker_encoder.encode(texts, batch_size=len(texts)), dtype=np.float32)
+
+
+class EmbeddingPool:
+    """
+    Encode on several processes, each holding one copy of the model and a pinned number of threads.
+    Texts are batched by length to cut padding, spread across the workers,
+    and the embeddings come back in input order. Has the same encode() as a single encoder.
+
+    args:
+        model_name: str
+            sentence-transformers model to load in every worker.
+        n_workers: int
+            Processes. Defaults to cpu count // threads_per_worker.
+        threads_per_worker: int
+            Intra-op threads of each worker's model.
+        backend: str
+            "torch" or "onnx", see load_encoder.
+        params: Dict
+            Encoder parameters other than threads, e.g. {"quantize": true}.
+        max_batch_tokens: int
+            Padded tokens per batch.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        n_workers=None,
+        threads_per_worker=2,
+        backend="torch",
+        params=None,
+        max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS,
+    ):
+        self.n_workers = n_workers or max(1, (os.cpu_count() or 1) // threads_per_worker)
+        self.max_batch_tokens = max_batch_tokens
+        params = dict(params or {}, num_threads=threads_per_worker)
+        if backend == "onnx":
+            # Export once here, rather than racing to write the same files from every worker.
+            prepare_onnx(
+                model_name,
+                params.get("quantize", False),
+                params.get("model_dir", DEFAULT_ONNX_MODEL_DIR),
+            )
+        # spawn, not fork: torch and tokenizers threads do not survive a fork.
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_name, backend, params),
+        )
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        texts = list(texts)
+        batches = length_batches(texts, self.max_batch_tokens)
+        results = self.executor.map(_encode_in_worker, [[texts[i] for i in b] for b in batches])
+        embeddings = None
+        for batch, batch_embeddings in zip(batches, results):
+            if embeddings is None:
+                embeddings = np.empty((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[batch] = batch_embeddings
+        return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def check_parity(encoder, reference, texts=PARITY_TEXTS, min_cosine=None):
+    """
+    Compare an encoder with the PyTorch reference on sample texts.
+    Raises ValueError when any embedding's cosine similarity with the reference is below min_cosine,
+    0.9999 for float32 and 0.99 for quantized encoders by default. Returns the lowest similarity.
+    """
+    if min_cosine is None:
+        min_cosine = 0.99 if getattr(encoder, "quantize", False) else 0.9999
+    a = np.asarray(encoder.encode(texts), dtype=np.float32)
+    b = np.asarray(reference.encode(texts), dtype=np.float32)
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    lowest = float(cosine.min())
+    if lowest < min_cosine:
+        raise ValueError(
+            f"Encoder embeddings drift from PyTorch: cosine {lowest:.5f} < {min_cosine}."
+        )
+    print(f"[INFO] Encoder parity with PyTorch: min cosine {lowest:.5f}.")
+    return lowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="all-MiniLM-L6-v2")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--n", type=int, default=2000, help="Texts to time encoding on.")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    reference = load_encoder(args.model, "torch", num_threads=args.threads)
+    encoder = load_encoder(args.model, "onnx", quantize=args.quantize, num_threads=args.threads)
+    check_parity(encoder, reference)
+
+    rng = np.random.default_rng(0)
+    words = " ".join(PARITY_TEXTS).split()
+    texts = [" ".join(rng.choice(words, size=rng.integers(20, 150))) for _ in range(args.n)]
+    for name, model in [("torch", reference), ("onnx", encoder)]:
+        start = time.perf_counter()
+        model.encode(texts, batch_size=args.batch_size)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>6}: {args.n / elapsed:8.1f} texts/s")
+
+
+if __name__ == "__main__":
+    main()
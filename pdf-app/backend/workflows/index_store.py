@@ -0,0 +1,108 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+
+DEFAULT_INDEX_STORE_DIR = os.getenv("INDEX_STORE_DIR", "data/index")
+EMBEDDINGS_FILE = "embeddings.npy"
+METADATA_FILE = "metadata.json"
+
+
+def content_hash(path, block_size=1 << 20):
+    """
+    sha256 of a file's bytes. The same PDF under any name has the same key.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class IndexStore:
+    """
+    On-disk store of fitted embedding indexes.
+    Each entry is a directory holding a float32 .npy matrix and a compact JSON metadata file,
+    keyed by embedding model name and the content hash of the source PDF(s).
+    Loading memory-maps the matrix, so a cold start costs a file open, not a re-encode.
+
+    args:
+        root: str
+            Directory to keep indexes in.
+        model_name: str
+            Embedding model the vectors were produced with; a different model never shares entries.
+
+    methods:
+        save(key, embeddings, chunks, pages, files) -> str:
+            Writes an index atomically and returns its directory.
+        load(key, mmap=True) -> Tuple[np.ndarray, Dict]:
+            Returns (embeddings, metadata) with metadata holding chunks, pages and files.
+        load_embeddings(key, mmap=True) -> np.ndarray:
+            Returns only the embedding matrix.
+    """
+
+    def __init__(self, root=DEFAULT_INDEX_STORE_DIR, model_name="all-MiniLM-L6-v2"):
+        self.root = root
+        self.model_name = model_name
+
+    def path(self, key):
+        return os.path.join(self.root, self.model_name, key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path(key), METADATA_FILE))
+
+    def save(self, key, embeddings, chunks, pages=None, files=None):
+        final_path = self.path(key)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        # Unique per call: threads of one process may save the same key at the same time.
+        tmp_path = tempfile.mkdtemp(prefix=f"{key}.tmp-", dir=os.path.dirname(final_path))
+
+        np.save(
+            os.path.join(tmp_path, EMBEDDINGS_FILE),
+            np.ascontiguousarray(embeddings, dtype=np.float32),
+        )
+        # Files repeat for every chunk, so keep each name once and store integer codes.
+        file_names, file_codes = [], []
+        if files is not None:
+            codes = {}
+            for f in files:
+                if f not in codes:
+                    codes[f] = len(file_names)
+                    file_names.append(f)
+                file_codes.append(codes[f])
+        metadata = {
+            "model_name": self.model_name,
+            "shape": list(embeddings.shape),
+            "chunks": list(chunks),
+            "pages": list(pages) if pages is not None else None,
+            "file_names": file_names,
+            "file_codes": file_codes,
+        }
+        with open(os.path.join(tmp_path, METADATA_FILE), "w") as f:
+            json.dump(metadata, f)
+
+        # Rename last, so a crash mid-write never leaves a half-written index under the real key.
+        try:
+            os.rename(tmp_path, final_path)
+        except OSError:
+            # Another worker saved the same key first; the contents are identical.
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        print("[DEBUG] Saved index:", final_path)
+        return final_path
+
+    def load_embeddings(self, key, mmap=True):
+        return np.load(
+            os.path.join(self.path(key), EMBEDDINGS_FILE), mmap_mode="r" if mmap else None
+        )
+
+    def load(self, key, mmap=True):
+        path = self.path(key)
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            metadata = json.load(f)
+        embeddings = self.load_embeddings(key, mmap=mmap)
+        metadata["files"] = [metadata["file_names"][c] for c in metadata["file_codes"]]
+        print("[DEBUG] Loaded index:", path, embeddings.shape)
+        return embeddings, metadata
@@ -0,0 +1,439 @@
+import mmap
+import numpy as np
+
+
+def normalize(embeddings):
+    """
+    L2-normalize rows as float32, so inner product is cosine similarity.
+    Rows that are already unit length (all-MiniLM-L6-v2 output is) are returned as is, without a copy,
+    so a memory-mapped matrix from the index store stays memory-mapped.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    if np.allclose(norms, 1, atol=1e-4):
+        return embeddings
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def topk(scores, k):
+    """
+    Row-wise top k of a score matrix, best first: argpartition to find the k, then sort only those.
+    """
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((len(scores), 0), np.int64), np.empty((len(scores), 0), scores.dtype)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def quantize_int8(vectors):
+    """
+    Symmetric scalar quantization with one scale per dimension: vectors ~= codes * scales.
+    """
+    scales = np.abs(vectors).max(axis=0, initial=0) / 127
+    scales[scales == 0] = 1
+    codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def resident_nbytes(a):
+    """
+    Bytes of an array held in process memory. Memory-mapped arrays, and views of them, count as 0.
+    """
+    base = a
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return 0
+        base = getattr(base, "base", None)
+    return a.nbytes
+
+
+class ExactIndex:
+    """
+    Exact nearest neighbors: one float32 matrix multiply against the pre-normalized embeddings,
+    then argpartition for the top k. Many queries at once cost a few BLAS calls.
+    Right for one PDF or up to a few hundred thousand chunks; every query scans every vector.
+
+    With storage="float16" or "int8" (per-dimension scales), the index holds 2x or 4x less memory
+    and pickles 2x or 4x smaller. Scores are then approximate, so with rescore=True the top
+    k * rescore_factor candidates are rescored exactly against the float32 vectors,
+    which are kept by reference only (e.g. a memory-mapped file) and never pickled.
+
+    Like the other backends, supports add() to append vectors and remove() to tombstone them;
+    removed ids are never returned, and the space is reclaimed when the caller rebuilds.
+
+    args:
+        n_neighbors: int
+            Default k for search.
+        storage: str
+            "float32", "float16" or "int8".
+        rescore: bool
+            Rescore quantized candidates exactly, when float32 vectors are attached.
+        rescore_factor: int
+            Candidates per result to rescore.
+        max_block_scores: int
+            Cap on the query x vector score matrix held at once; larger query batches are split.
+    """
+
+    name = "exact"
+    storages = ("float32", "float16", "int8")
+    row_block = 1 << 16  # Quantized rows converted to float32 at a time while scoring.
+
+    def __init__(
+        self,
+        n_neighbors=6,
+        storage="float32",
+        rescore=True,
+        rescore_factor=4,
+        max_block_scores=1 << 26,
+    ):
+        if storage not in self.storages:
+            raise ValueError(f"Unknown storage {storage}. Choose one of {self.storages}.")
+        self.n_neighbors = n_neighbors
+        self.storage = storage
+        self.rescore = rescore
+        self.rescore_factor = rescore_factor
+        self.max_block_scores = max_block_scores
+        self.rescore_vectors = None
+
+    def build(self, embeddings):
+        vectors = normalize(embeddings)
+        self.n = len(vectors)
+        if self.storage == "float32":
+            self.vectors = vectors
+        elif self.storage == "float16":
+            self.vectors = vectors.astype(np.float16)
+        else:
+            self.vectors, self.scales = quantize_int8(vectors)
+        if self.storage != "float32":
+            self.attach_vectors(vectors)
+        self.deleted = np.zeros(self.n, dtype=bool)
+        return self
+
+    def add(self, embeddings):
+        """
+        Append vectors, with ids len(self) onwards. Quantized storage reuses the scales from build,
+        unless the index was built empty: then the first vectors added set them.
+        """
+        if self.n == 0:
+            return self.build(embeddings)
+        vectors = normalize(embeddings)
+        if self.storage == "float32":
+            codes = vectors
+        elif self.storage == "float16":
+            codes = vectors.astype(np.float16)
+        else:
+            codes = np.clip(np.rint(vectors / self.scales), -127, 127).astype(np.int8)
+        self.vectors = np.concatenate([self.vectors, codes])
+        if self.rescore_vectors is not None:
+            self.rescore_vectors = np.concatenate([self.rescore_vectors, vectors])
+        self.deleted = np.concatenate([self.deleted, np.zeros(len(vectors), dtype=bool)])
+        self.n = len(self.vectors)
+        return self
+
+    def remove(self, ids):
+        self.deleted[ids] = True
+
+    def attach_vectors(self, embeddings):
+        """
+        Point the index at float32 embeddings equal to the ones it was built from,
+        e.g. the memory-mapped copy in the index store, so the in-memory copy can be freed.
+        """
+        if self.storage == "float32":
+            self.vectors = normalize(embeddings)
+        elif self.rescore:
+            self.rescore_vectors = normalize(embeddings)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["rescore_vectors"] = None
+        return state
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        """
+        Every query scans every stored vector, so their pages stay resident
+        even when they are memory-mapped: count them at full size.
+        """
+        n = self.vectors.nbytes
+        if self.storage == "int8":
+            n += self.scales.nbytes
+        return n
+
+    def search(self, queries, k=None):
+        k = min(k or self.n_neighbors, self.n)
+        queries = normalize(np.atleast_2d(queries))
+        if k <= 0:
+            return np.empty((len(queries), 0), np.int64), np.empty((len(queries), 0), np.float32)
+        rescore = self.rescore_vectors is not None
+        n_candidates = min(k * self.rescore_factor, self.n) if rescore else k
+        block = max(1, self.max_block_scores // max(self.n, 1))
+        indices, scores = [], []
+        for start in range(0, len(queries), block):
+            block_queries = queries[start : start + block]
+            block_indices, block_scores = topk(self._scores(block_queries), n_candidates)
+            if rescore:
+                block_indices, block_scores = self._rescore(block_queries, block_indices, k)
+            indices.append(block_indices)
+            scores.append(block_scores)
+        indices, scores = np.vstack(indices), np.vstack(scores)
+        # Fewer live vectors than k: tombstones fill the tail with -inf scores.
+        indices[~np.isfinite(scores)] = -1
+        return indices, scores
+
+    def _scores(self, queries):
+        scores = self._raw_scores(queries)
+        if self.deleted.any():
+            scores[:, self.deleted] = -np.inf
+        return scores
+
+    def _raw_scores(self, queries):
+        if self.storage == "float32":
+            return queries @ self.vectors.T
+        if self.storage == "int8":
+            # (q * scales) . codes == q . (codes * scales), without dequantizing the matrix.
+            queries = queries * self.scales
+        scores = np.empty((len(queries), self.n), dtype=np.float32)
+        for start in range(0, self.n, self.row_block):
+            rows = self.vectors[start : start + self.row_block].astype(np.float32)
+            scores[:, start : start + len(rows)] = queries @ rows.T
+        return scores
+
+    def _rescore(self, queries, candidates, k):
+        vectors = self.rescore_vectors[candidates.ravel()].reshape(*candidates.shape, -1)
+        exact = np.einsum("qd,qcd->qc", queries, vectors)
+        exact[self.deleted[candidates]] = -np.inf
+        order = np.argsort(-exact, axis=1)[:, :k]
+        return (
+            np.take_along_axis(candidates, order, axis=1),
+            np.take_along_axis(exact, order, axis=1),
+        )
+
+
+class HNSWIndex:
+    """
+    Approximate nearest neighbors on an HNSW graph, with hnswlib.
+    Query time grows with log(n) instead of n; build is slower than exact.
+
+    args:
+        n_neighbors: int
+            Default k for search.
+        M: int
+            Graph degree. Higher is better recall and more memory.
+        ef_construction: int
+            Candidate list size while building. Higher is better graph quality and slower builds.
+        ef_search: int
+            Candidate list size while querying; the recall/latency knob. Always at least k.
+        num_threads: int
+            Threads for build and batch queries. -1 uses all cores.
+    """
+
+    name = "hnsw"
+
+    def __init__(
+        self, n_neighbors=6, M=16, ef_construction=200, ef_search=64, num_threads=-1
+    ):
+        self.n_neighbors = n_neighbors
+        self.M = M
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.num_threads = num_threads
+
+    def build(self, embeddings):
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError(
+                "The hnsw index backend needs hnswlib. Install it with `pip install hnswlib`."
+            )
+        embeddings = normalize(embeddings)
+        self.n, dim = embeddings.shape
+        self.index = hnswlib.Index(space="ip", dim=dim)
+        self.index.init_index(
+            max_elements=max(self.n, 1), M=self.M, ef_construction=self.ef_construction
+        )
+        if self.n:
+            self.index.add_items(embeddings, np.arange(self.n), num_threads=self.num_threads)
+        self.n_deleted = 0
+        return self
+
+    def add(self, embeddings):
+        """
+        Insert vectors into the graph, with ids len(self) onwards. Capacity at least doubles when full.
+        """
+        embeddings = normalize(embeddings)
+        n_new = len(embeddings)
+        capacity = self.index.get_max_elements()
+        if self.n + n_new > capacity:
+            self.index.resize_index(max(self.n + n_new, 2 * capacity))
+        self.index.add_items(
+            embeddings, np.arange(self.n, self.n + n_new), num_threads=self.num_threads
+        )
+        self.n += n_new
+        return self
+
+    def remove(self, ids):
+        # hnswlib keeps deleted nodes for graph connectivity and skips them in results.
+        for i in ids:
+            self.index.mark_deleted(int(i))
+        self.n_deleted += len(ids)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        """
+        Estimate from hnswlib's layout: every allocated slot holds the float32 vector,
+        2 * M level-0 links, a label and a link count; upper levels add about 1 / M of that.
+        """
+        per_element = 4 * self.index.dim + 4 * 2 * self.M + 16
+        return int(self.index.get_max_elements() * per_element * (1 + 1 / self.M))
+
+    def search(self, queries, k=None):
+        queries = normalize(np.atleast_2d(queries))
+        k = min(k or self.n_neighbors, self.n - self.n_deleted)
+        if k <= 0:
+            return np.empty((len(queries), 0), np.int64), np.empty((len(queries), 0), np.float32)
+        self.index.set_ef(max(self.ef_search, k))
+        labels, distances = self.index.knn_query(queries, k=k, num_threads=self.num_threads)
+        # hnswlib's "ip" distance is 1 - inner product.
+        return labels.astype(np.int64), 1 - distances
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbors with an inverted file: vectors are bucketed by k-means centroid,
+    and a query only scans the n_probe buckets with the closest centroids. Needs only numpy and sklearn.
+
+    args:
+        n_neighbors: int
+            Default k for search.
+        n_lists: int
+            Number of buckets. Defaults to about sqrt(n).
+        n_probe: int
+            Buckets scanned per query; the recall/latency knob.
+        max_train_size: int
+            Vectors sampled to train the centroids.
+    """
+
+    name = "ivf"
+
+    def __init__(self, n_neighbors=6, n_lists=None, n_probe=8, max_train_size=100_000):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.max_train_size = max_train_size
+
+    def build(self, embeddings):
+        """
+        Train the centroids and bucket the vectors. With no vectors, training waits for the first add().
+        """
+        from sklearn.cluster import MiniBatchKMeans
+
+        embeddings = normalize(embeddings)
+        self.n = len(embeddings)
+        if self.n == 0:
+            self.centroids = np.empty((0, embeddings.shape[-1]), dtype=np.float32)
+            self.deleted = np.zeros(0, dtype=bool)
+            self._group(np.arange(0, dtype=np.int64), embeddings, np.arange(0, dtype=np.int64))
+            return self
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(self.n))), self.n)
+        rng = np.random.default_rng(0)
+        train = embeddings
+        if self.n > self.max_train_size:
+            train = embeddings[rng.choice(self.n, self.max_train_size, replace=False)]
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=0, n_init=3).fit(train)
+        self.centroids = normalize(kmeans.cluster_centers_)
+        self.deleted = np.zeros(self.n, dtype=bool)
+        self._group(
+            np.arange(self.n, dtype=np.int64),
+            embeddings,
+            np.argmax(embeddings @ self.centroids.T, axis=1),
+        )
+        return self
+
+    def _group(self, ids, vectors, lists):
+        # Store vectors grouped by list, so each probed list is one contiguous slice.
+        order = np.argsort(lists, kind="stable")
+        self.ids = ids[order]
+        self.vectors = vectors[order]
+        self.offsets = np.searchsorted(lists[order], np.arange(len(self.centroids) + 1))
+
+    def add(self, embeddings):
+        """
+        Assign vectors to the existing centroids, with ids len(self) onwards.
+        Centroids are not retrained; rebuild once the data has drifted far from them.
+        """
+        if self.n == 0:
+            return self.build(embeddings)
+        embeddings = normalize(embeddings)
+        n_new = len(embeddings)
+        lists = np.repeat(np.arange(len(self.centroids)), np.diff(self.offsets))
+        self._group(
+            np.concatenate([self.ids, np.arange(self.n, self.n + n_new, dtype=np.int64)]),
+            np.concatenate([self.vectors, embeddings]),
+            np.concatenate([lists, np.argmax(embeddings @ self.centroids.T, axis=1)]),
+        )
+        self.deleted = np.concatenate([self.deleted, np.zeros(n_new, dtype=bool)])
+        self.n += n_new
+        return self
+
+    def remove(self, ids):
+        self.deleted[ids] = True
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def nbytes(self):
+        # The normalized vectors, regrouped by list, are a resident copy even of memory-mapped embeddings.
+        arrays = (self.vectors, self.ids, self.offsets, self.centroids, self.deleted)
+        return sum(resident_nbytes(a) for a in arrays)
+
+    def search(self, queries, k=None):
+        k = min(k or self.n_neighbors, self.n)
+        queries = normalize(np.atleast_2d(queries))
+        if k <= 0:
+            return np.empty((len(queries), 0), np.int64), np.empty((len(queries), 0), np.float32)
+        n_probe = min(self.n_probe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :n_probe]
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for qi, (query, lists) in enumerate(zip(queries, probes)):
+            rows = np.concatenate(
+                [np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists]
+            )
+            rows = rows[~self.deleted[self.ids[rows]]]
+            candidate_scores = self.vectors[rows] @ query
+            top = np.argsort(-candidate_scores)[:k]
+            indices[qi, : len(top)] = self.ids[rows[top]]
+            scores[qi, : len(top)] = candidate_scores[top]
+        return indices, scores
+
+
+INDEX_BACKENDS = {
+    ExactIndex.name: ExactIndex,
+    HNSWIndex.name: HNSWIndex,
+    IVFIndex.name: IVFIndex,
+}
+
+
+def make_index(backend="exact", **params):
+    """
+    Make an unbuilt index by backend name: "exact", "hnsw" or "ivf".
+    params go to the backend's constructor, e.g. make_index("hnsw", ef_search=128).
+
+    Every backend has build(embeddings), search(queries, k) -> (indices, scores),
+    add(embeddings) to append vectors and remove(ids) to tombstone them.
+    """
+    if backend not in INDEX_BACKENDS:
+        raise ValueError(
+            f"Unknown index backend {backend}. Choose one of {list(INDEX_BACKENDS)}."
+        )
+    return INDEX_BACKENDS[backend](**params)
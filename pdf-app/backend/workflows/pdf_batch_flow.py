@@ -10,13 +10,21 @@ from metaflow import (
     S3,
     environment,
     retry,
-    kubernetes
+    kubernetes,
+    JSONType,
 )
-from metaflow.cards import Table, VegaChart
+from metaflow.cards import Markdown, Table, VegaChart
 import os
 import json
 
 IMAGE = 'docker.io/eddieob/pdf-backend-workflow:latest'
+EMBEDDING_CACHE_KEY = "embedding_cache.sqlite"
+CHUNKS_KEY = "chunks.parquet"
+EMBEDDINGS_KEY = "embeddings.npy"
+CARD_PREVIEW_ROWS = 200  # Sampled chunks shown in the table card.
+# Page extraction processes, then embedding threads, per extract_text task.
+EXTRACT_CPU = 4
+JOIN_CPU = 8  # Index build threads in join.
 
 # @pypi_base(python="3.12")
 class PDFRAGIndexing(FlowSpec):
@@ -31,68 +39,242 @@ class PDFRAGIndexing(FlowSpec):
         default="pdfList.txt",
         is_text=True,
     )
+    index_backend = Parameter(
+        "index_backend",
+        help="Nearest neighbor index backend: exact, hnsw or ivf.",
+        default="exact",
+    )
+    index_params = Parameter(
+        "index_params",
+        help="JSON of index build and query parameters, e.g. '{\"ef_search\": 128}', "
+        "or '{\"storage\": \"int8\"}' for a 4x smaller exact index artifact.",
+        type=JSONType,
+        default="{}",
+    )
+    embedding_backend = Parameter(
+        "embedding_backend",
+        help="Chunk encoder: torch (sentence-transformers) or onnx (ONNX Runtime).",
+        default="torch",
+    )
+    embedding_params = Parameter(
+        "embedding_params",
+        help="JSON of encoder parameters, e.g. '{\"quantize\": true, \"num_threads\": 4}'.",
+        type=JSONType,
+        default="{}",
+    )
+    embedding_workers = Parameter(
+        "embedding_workers",
+        help=f"Embedding processes per extract_text task, each with {EXTRACT_CPU} // embedding_workers threads.",
+        type=int,
+        default=1,
+    )
+    download_workers = Parameter(
+        "download_workers",
+        help="Concurrent PDF downloads in start.",
+        type=int,
+        default=16,
+    )
+    n_shards = Parameter(
+        "n_shards",
+        help="Target number of extract_text tasks. Small PDFs are grouped, large ones split by page range.",
+        type=int,
+        default=32,
+    )
+    shard_weight = Parameter(
+        "shard_weight",
+        help="Balance shards by PDF bytes or pages.",
+        default="bytes",
+    )
+    incremental = Parameter(
+        "incremental",
+        help="Reuse chunks and embeddings of PDFs unchanged since the latest successful run.",
+        type=bool,
+        default=True,
+    )
+    projection = Parameter(
+        "projection",
+        help="2-D projection for the embeddings plot: pca, random, tsne, or none to skip the plot. "
+        "Runs after the index is built.",
+        default="pca",
+    )
+    max_chart_points = Parameter(
+        "max_chart_points",
+        help="Chunks in the embeddings plot, sampled per file above this.",
+        type=int,
+        default=5000,
+    )
     tmp_dir = "/tmp/pdf"
 
     @step
     def start(self):
         import os
-        from pdf_utils import download_pdf
+        from pdf_utils import download_pdfs, plan_shards
+        from index_store import content_hash
 
         if self.local_pdf_path is None and self.url_list is None:
             raise ValueError(
                 "Either local_pdf_path or local_pdf_path or url_list param must be provided."
             )
 
-        self.s3_pdf_paths = []
+        # (S3 key, local path) of every PDF, uploaded in one batch at the end.
+        uploads = []
         if self.url_list is not None:
             print('DEBUG', self.url_list)
             ls = self.url_list.strip().split("\n")
+            downloads = []
             for line in ls:
                 split = line.strip().split(": ")
                 name, url = split[0], split[1]
                 name = name.strip() + ".pdf"
                 if not url.startswith("http"):
                     raise ValueError(f"Invalid URL: {url}")
-                if not os.path.exists(self.tmp_dir):
-                    os.makedirs(self.tmp_dir)
-                local_tmp_path = f"{self.tmp_dir}/{name}"
-                download_pdf(url, local_tmp_path)
-                with S3(run=self) as s3:
-                    s3.put_files([(name, local_tmp_path)])
-                    self.s3_pdf_paths.append(name)
+                downloads.append((name, url, f"{self.tmp_dir}/{name}"))
+            if not os.path.exists(self.tmp_dir):
+                os.makedirs(self.tmp_dir)
+            ok = download_pdfs(
+                [(url, path) for _, url, path in downloads],
+                max_workers=self.download_workers,
+            )
+            uploads += [(name, path) for (name, _, path), success in zip(downloads, ok) if success]
+            print(f"[INFO] Downloaded {sum(ok)} of {len(downloads)} PDFs.")
 
         if self.local_pdf_path is not None:
             if not os.path.exists(self.local_pdf_path):
                 raise FileNotFoundError(
                     f"Directory {self.local_pdf_path} does not exist."
                 )
+            for root, _, files in os.walk(self.local_pdf_path):
+                for file in files:
+                    uploads.append((file, os.path.join(root, file)))
+
+        # Content hash of every PDF in this run; join saves it for the next run to compare against.
+        self.manifest = {name: {"hash": content_hash(path)} for name, path in uploads}
+        self.encoder_key = self._encoder_key()
+        self.prev_run, prev_manifest = self._previous_manifest()
+        prev_names = {entry["hash"]: name for name, entry in prev_manifest.items()}
+        # Current file name -> file name in the previous run, for PDFs whose bytes did not change.
+        self.reused = {
+            name: prev_names[entry["hash"]]
+            for name, entry in self.manifest.items()
+            if entry["hash"] in prev_names
+        }
+        uploads = [(name, path) for name, path in uploads if name not in self.reused]
+        print(f"[INFO] Reusing {len(self.reused)} unchanged PDFs, processing {len(uploads)}.")
+
+        with S3(run=self) as s3:
+            s3.put_files(uploads)
+        self.s3_pdf_paths = [name for name, _ in uploads]
+        # foreach needs at least one task; an empty shard only passes through.
+        self.shards = plan_shards(uploads, self.n_shards, weight=self.shard_weight) or [[]]
+        print(f"[INFO] {len(uploads)} PDFs in {len(self.shards)} shards.")
+        self.next(self.extract_text, foreach="shards")
+
+    def _encoder_key(self):
+        from semantic_search import TEXT_EMBEDDING_MODEL_INFO
+        from encoders import encoder_name
 
-            with S3(run=self) as s3:
-                for root, _, files in os.walk(self.local_pdf_path):
-                    for file in files:
-                        s3.put_files([(file, os.path.join(root, file))])
-                        self.s3_pdf_paths.append(file)
+        return encoder_name(
+            TEXT_EMBEDDING_MODEL_INFO["model_name"],
+            self.embedding_backend,
+            **self.embedding_params,
+        )
 
-        self.next(self.extract_text, foreach="s3_pdf_paths")
+    def _previous_manifest(self):
+        """
+        (pathspec, manifest) of the latest successful run whose embeddings can be reused,
+        or (None, {}) when there is none or incremental is off.
+        """
+        from metaflow import Flow
+
+        if not self.incremental:
+            return None, {}
+        try:
+            prev_run = Flow(current.flow_name).latest_successful_run
+        except Exception as e:
+            print(f"[INFO] No previous run to reuse: {e}")
+            return None, {}
+        if prev_run is None or not hasattr(prev_run.data, "manifest"):
+            return None, {}
+        if not hasattr(prev_run.data, "chunks_url") or not hasattr(prev_run.data, "embeddings_url"):
+            print(f"[INFO] Run {prev_run.id} has no persisted chunks and embeddings, re-embedding all.")
+            return None, {}
+        if prev_run.data.encoder_key != self.encoder_key:
+            print(f"[INFO] Run {prev_run.id} used encoder {prev_run.data.encoder_key}, re-embedding all.")
+            return None, {}
+        return prev_run.pathspec, prev_run.data.manifest
 
     @retry
     # @pypi(packages={"pymupdf": "1.24.6"})
-    @kubernetes(image=IMAGE)
+    @kubernetes(image=IMAGE, cpu=EXTRACT_CPU)
+    @environment(vars={"TOKENIZERS_PARALLELISM": "false"})
     @step
     def extract_text(self):
-        from pdf_utils import pdf_to_text, text_to_chunks
+        from pdf_utils import iter_pdf_pages, make_pdf_executor, text_to_chunks
+        from chunk_table import chunk_table
 
-        self.file_name = self.input
-        self.pdf_path = f"{self.tmp_dir}/{self.file_name}"
+        # A shard is a list of (file name, start page, end page) units.
+        self.units = self.input
+        file_names = sorted({name for name, _, _ in self.units})
         if not os.path.exists(self.tmp_dir):
             os.makedirs(self.tmp_dir)
+        paths = {}
         with S3(run=self) as s3:
-            obj = s3.get(self.input)
-            os.rename(obj.path, self.pdf_path)
-        text_ls = pdf_to_text(self.pdf_path)
-        self.chunks = text_to_chunks(text_ls)
+            for obj in s3.get_many(file_names) if file_names else []:
+                paths[obj.key] = f"{self.tmp_dir}/{obj.key}"
+                os.rename(obj.path, paths[obj.key])
+
+        # Chunk, page and file name of every unit, in unit order.
+        texts, pages, files = [], [], []
+        # One pool of extraction processes for all units, not one per unit.
+        executor = make_pdf_executor(EXTRACT_CPU)
+        try:
+            for name, start_page, end_page in self.units:
+                # Chunk pages as they stream out of the extraction processes.
+                unit_pages = iter_pdf_pages(
+                    paths[name],
+                    start_page=start_page,
+                    end_page=end_page,
+                    n_workers=EXTRACT_CPU,
+                    executor=executor,
+                )
+                for chunk, page in text_to_chunks(unit_pages, start_page=start_page):
+                    texts.append(chunk)
+                    pages.append(page)
+                    files.append(name)
+        finally:
+            executor.shutdown()
+        self.chunks = chunk_table(texts, pages, files)
+        # Embed this shard's chunks here, so encoding runs in parallel across the foreach.
+        self.embeddings = self._embed_shard(texts, files)
         self.next(self.join)
 
+    def _embed_shard(self, texts, files):
+        """
+        float32 embeddings of one task's chunks, in order. Reads the previous run's embedding cache,
+        but does not write it back; join merges every shard into the next cache.
+        With incremental reuse the cache is not read: shards then hold only new or changed PDFs,
+        whose chunks mostly miss it, and every task would download all of it.
+        """
+        from semantic_search import SemanticSearchModel
+
+        embedding_cache = None
+        if self.prev_run is None:
+            embedding_cache = self._open_embedding_cache(self._restore_embedding_cache())
+        encoder = SemanticSearchModel(
+            embedding_cache=embedding_cache,
+            embedding_backend=self.embedding_backend,
+            embedding_params=dict(
+                {"num_threads": max(1, EXTRACT_CPU // self.embedding_workers)},
+                **self.embedding_params,
+            ),
+            embedding_workers=self.embedding_workers,
+        )
+        embeddings = encoder.embed(texts, files) if texts else None
+        encoder.close()
+        if embedding_cache is not None:
+            embedding_cache.close()
+        return embeddings
+
     # @pypi(
     #     packages={
     #         "sentence-transformers": "3.0.1",
@@ -102,31 +284,245 @@ class PDFRAGIndexing(FlowSpec):
     #     }
     # )
     @retry
-    @card(type='blank', id='plot')
     @card(type='blank', id='table')
-    @kubernetes(image=IMAGE)
-    @environment(vars={"TOKENIZERS_PARALLELISM": "false"})
+    @kubernetes(image=IMAGE, cpu=JOIN_CPU)
     @step
     def join(self, inputs):
-        self.chunks = []
+        import numpy as np
+        from chunk_table import chunk_stats, chunk_table, concat_chunk_tables
+
+        self.merge_artifacts(inputs, include=["manifest", "encoder_key", "prev_run", "reused"])
+        tables, shards = [], []
         for i in inputs:
-            for c in i.chunks:
-                self.chunks.append([c[0], c[1], i.file_name])
-        current.card['table'].append(Table(headers=["Chunk", "Page", "File"], data=self.chunks))
-        chunks = [c[0] for c in self.chunks]
-        files = [c[2] for c in self.chunks]
-        self.model, altChart = self._fit(chunks, files)
-
-        self.chart_json = json.dumps(altChart.to_dict())
-        current.card['plot'].append(VegaChart.from_altair_chart(altChart))
+            tables.append(i.chunks)
+            if i.embeddings is not None:
+                shards.append(i.embeddings)
+        # Shards are in input order, as are the chunks, so row i embeds chunk i.
+        new_chunks = concat_chunk_tables(tables)
+        new_embeddings = np.concatenate(shards) if shards else None
+
+        recommender = self._index(new_chunks, new_embeddings)
+        # Row i of the chunks, the embeddings and the deleted mask is id i in the index.
+        # Rows of removed files stay, tombstoned, until the index is compacted.
+        chunks = chunk_table(recommender.chunks, recommender.pages, recommender.files)
+        self.deleted = recommender.deleted
+        self.model = recommender.nn
+        self.index_config = self._index_config()
+
+        # Chunks are a Parquet file next to the run, not an artifact, so consumers can read
+        # single columns or row ranges with chunk_table.ChunkTable.from_url(run.data.chunks_url).
+        self.chunks_url = self._persist_chunks(chunks)
+        # Embeddings too: an .npy file that visualize and the next run memory-map or load whole.
+        self.embeddings_url = self._persist_embeddings(recommender.embeddings)
+        live = chunks.filter(~self.deleted)
+        self.chunk_stats = chunk_stats(live)
+        self._chunks_card(live, self.chunk_stats)
+        del chunks, live
+        self._update_embedding_cache(new_chunks.column("text").to_pylist(), new_embeddings)
+        self.next(self.visualize)
+
+    # @pypi(packages={"scikit-learn": "1.5.0", "altair": "5.3.0", "pandas": "2.2.2"})
+    @card(type='blank', id='plot')
+    @kubernetes(image=IMAGE)
+    @step
+    def visualize(self):
+        """
+        Embeddings plot, off the index build: the model artifact is already persisted by join.
+        """
+        import numpy as np
+        from chunk_table import ChunkTable
+        from projection import embedding_chart, sample_per_file
+
+        if self.projection != "none":
+            chunks = ChunkTable.from_url(self.chunks_url)
+            embeddings = self._load_embeddings(self.embeddings_url, mmap_mode="r")
+            # Sample live rows on the file column, then materialize only the sampled texts.
+            live = np.flatnonzero(~self.deleted)
+            files = np.asarray(chunks.column("file").to_pylist(), dtype=object)
+            rows = live[sample_per_file(files[live], self.max_chart_points)]
+            texts = chunks.column("text").take(rows).to_pylist()
+            altChart = embedding_chart(
+                embeddings[rows],
+                texts,
+                files[rows].tolist(),
+                method=self.projection,
+                max_points=len(rows),
+                n_total=len(live),
+            )
+            self.chart_json = json.dumps(altChart.to_dict())
+            current.card['plot'].append(VegaChart.from_altair_chart(altChart))
         self.next(self.end)
 
-    def _fit(self, chunks, files):
+    def _index_config(self):
+        return {"backend": self.index_backend, "params": dict(self.index_params)}
+
+    def _index(self, new_chunks, new_embeddings):
+        """
+        The search model over all chunks. With a previous run to build on, its index is updated in place:
+        chunks of files that are gone or changed are removed, unchanged files are relabeled
+        with their current names, and new chunks are added. The index is only rebuilt when
+        removed chunks reach the model's compact_ratio, or when it was built with other parameters.
+        """
+        import numpy as np
+        from metaflow import Run
         from semantic_search import SemanticSearchModel
+        from chunk_table import ChunkTable
+
+        recommender = SemanticSearchModel(
+            index_backend=self.index_backend,
+            index_params=self.index_params,
+            embedding_backend=self.embedding_backend,
+            embedding_params=self.embedding_params,
+        )
+        texts, pages, files = (new_chunks.column(c).to_pylist() for c in ("text", "page", "file"))
+        if self.prev_run is None:
+            recommender.fit_embeddings(texts, files, new_embeddings, pages=pages)
+            return recommender
+
+        prev = Run(self.prev_run).data
+        prev_chunks = ChunkTable.from_url(prev.chunks_url).read()
+        same_index = hasattr(prev, "index_config") and prev.index_config == self._index_config()
+        recommender.resume(
+            prev_chunks.column("text").to_pylist(),
+            prev_chunks.column("file").to_pylist(),
+            self._load_embeddings(prev.embeddings_url),
+            nn=prev.model if same_index else None,
+            deleted=prev.deleted if hasattr(prev, "deleted") else None,
+            pages=prev_chunks.column("page").to_pylist(),
+        )
+        del prev_chunks
+        current_names = {}  # Previous name of an unchanged file -> its current names.
+        for name, prev_name in sorted(self.reused.items()):
+            current_names.setdefault(prev_name, []).append(name)
+        n_removed = recommender.remove(sorted(set(recommender.files) - set(current_names)))
+        recommender.rename({prev_name: names[0] for prev_name, names in current_names.items()})
+        # The same content under more than one name: every further name gets a copy of its chunks.
+        for names in current_names.values():
+            rows = [
+                i
+                for i, f in enumerate(recommender.files)
+                if f == names[0] and not recommender.deleted[i]
+            ]
+            for name in names[1:]:
+                recommender.add(
+                    [recommender.chunks[i] for i in rows],
+                    [name] * len(rows),
+                    embeddings=np.asarray(recommender.embeddings)[rows],
+                    pages=[recommender.pages[i] for i in rows],
+                )
+        if texts:
+            recommender.add(texts, files, embeddings=new_embeddings, pages=pages)
+        print(
+            f"[INFO] Updated the index of run {self.prev_run}: {len(texts)} chunks added, "
+            f"{n_removed} removed, {int((~recommender.deleted).sum())} live."
+        )
+        return recommender
+
+    def _persist_chunks(self, chunks):
+        from chunk_table import write_chunks
+
+        path = write_chunks(chunks, self._task_path(CHUNKS_KEY))
+        with S3(run=self) as s3:
+            [(_, url)] = s3.put_files([(CHUNKS_KEY, path)])
+        return url
+
+    def _persist_embeddings(self, embeddings):
+        import numpy as np
+
+        path = self._task_path(EMBEDDINGS_KEY)
+        np.save(path, np.asarray(embeddings, dtype=np.float32))
+        with S3(run=self) as s3:
+            [(_, url)] = s3.put_files([(EMBEDDINGS_KEY, path)])
+        return url
+
+    def _load_embeddings(self, url, mmap_mode=None):
+        """
+        Embeddings persisted by _persist_embeddings. With mmap_mode="r", rows are read from disk on access.
+        """
+        import tempfile
+        import numpy as np
 
-        recommender = SemanticSearchModel()
-        chart = recommender.fit(chunks, files)
-        return recommender.nn, chart
+        fd, path = tempfile.mkstemp(suffix=".npy")
+        os.close(fd)
+        with S3() as s3:
+            os.rename(s3.get(url).path, path)
+        return np.load(path, mmap_mode=mmap_mode)
+
+    def _task_path(self, key):
+        # Per task: local runs execute foreach tasks side by side in the same tmp_dir.
+        if not os.path.exists(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+        return f"{self.tmp_dir}/{current.task_id}-{key}"
+
+    def _chunks_card(self, chunks, stats):
+        """
+        Summary stats and a per-file sample of the chunks: the card stays small for any corpus.
+        """
+        from chunk_table import file_codes
+        from projection import sample_per_file
+
+        card = current.card['table']
+        card.append(
+            Markdown(
+                f"**{stats['n_chunks']}** chunks from **{stats['n_files']}** files, "
+                f"{stats['mean_chunk_chars']:.0f} characters per chunk on average."
+            )
+        )
+        card.append(
+            Table(
+                headers=["File", "Chunks", "Pages"],
+                data=[[f["file"], f["chunks"], f["pages"]] for f in stats["files"]],
+            )
+        )
+        rows = sample_per_file(file_codes(chunks)[1], CARD_PREVIEW_ROWS)
+        preview = chunks.take(rows).to_pydict()
+        card.append(Markdown(f"Sample of {len(rows)} chunks:"))
+        card.append(
+            Table(
+                headers=["Chunk", "Page", "File"],
+                data=[list(r) for r in zip(preview["text"], preview["page"], preview["file"])],
+            )
+        )
+
+    def _update_embedding_cache(self, texts, embeddings):
+        # Only new chunks: reused ones are in the cache from their own run already.
+        cache_path = self._restore_embedding_cache()
+        embedding_cache = self._open_embedding_cache(cache_path)
+        if texts:
+            embedding_cache.put(texts, embeddings)
+        embedding_cache.close()
+        self._persist_embedding_cache(cache_path)
+
+    def _open_embedding_cache(self, cache_path):
+        from embedding_cache import EmbeddingCache
+
+        return EmbeddingCache(self._encoder_key(), path=cache_path)
+
+    def _restore_embedding_cache(self):
+        """
+        Start from the embedding cache of the latest successful run, if there is one,
+        so chunks embedded by earlier runs are not encoded again.
+        """
+        from metaflow import Flow
+
+        cache_path = self._task_path(EMBEDDING_CACHE_KEY)
+        try:
+            prev_run = Flow(current.flow_name).latest_successful_run
+        except Exception as e:
+            print(f"[INFO] No previous run to restore the embedding cache from: {e}")
+            return cache_path
+        if prev_run is None:
+            return cache_path
+        with S3(run=prev_run) as s3:
+            obj = s3.get(EMBEDDING_CACHE_KEY, return_missing=True)
+            if obj.exists:
+                os.rename(obj.path, cache_path)
+                print(f"[INFO] Restored embedding cache from run {prev_run.id}.")
+        return cache_path
+
+    def _persist_embedding_cache(self, cache_path):
+        with S3(run=self) as s3:
+            s3.put_files([(EMBEDDING_CACHE_KEY, cache_path)])
 
     @step
     def end(self):
@@ -1,22 +1,113 @@
+import os
 import re
+import sys
+import time
+import heapq
+import bisect
 import requests
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
-def preprocess(text):
-    text = text.replace("\n", " ")
-    text = re.sub(r"\s+", " ", text)
-    return text
+DEFAULT_PAGES_PER_TASK = 16
+SHARD_WEIGHTS = ("bytes", "pages")
+# Smallest page range a large PDF is split into; below this, task overhead beats the parallelism.
+MIN_SPLIT_PAGES = 50
+DEFAULT_DOWNLOAD_WORKERS = 16
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0  # Seconds before the first retry; doubles on each one.
+# Worth retrying: rate limiting and server-side failures. Other 4xx will not change.
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
-def pdf_to_text(path, start_page=1, end_page=None):
+def _import_fitz():
     try:
         import pymupdf as fitz  # available with v1.24.3
     except ImportError:
         import fitz
-    doc = fitz.open(path)
-    total_pages = doc.page_count
-    if end_page is None:
-        end_page = total_pages
+    return fitz
+
+
+def _open_pdf(path):
+    return _import_fitz().open(path)
+
+
+def warm_pdf_worker(_=None):
+    """
+    Import fitz in a pool worker ahead of its first PDF. Module-level, so it pickles by reference
+    and importing it also imports this module in the worker.
+    """
+    _import_fitz()
+
+
+def preprocess(text):
+    text = text.replace("\n", " ")
+    text = re.sub(r"\s+", " ", text)
+    return text
+
+
+def page_count(path):
+    doc = _open_pdf(path)
+    n = doc.page_count
+    doc.close()
+    return n
+
+
+def plan_shards(files, n_shards, weight="bytes", min_split_pages=MIN_SPLIT_PAGES):
+    """
+    Group PDFs into at most n_shards shards of about equal work, for a foreach.
+    Small files are packed together; a file heavier than a shard's share is split
+    into page ranges of at least min_split_pages pages, which can land on different shards.
+    Chunks carry a page's leftover words into the next page, so a split is not free:
+    the last chunk of a range is cut short, and the chunk boundaries of the next range shift.
+
+    args:
+        files: List[Tuple[str, str]]
+            (name, local path) of each PDF.
+        weight: str
+            "bytes" (file size; pages are only counted for files that may be split)
+            or "pages" (page count of every file).
+
+    returns:
+        List of shards, each a list of (name, start_page, end_page) units, 1-indexed and inclusive.
+        end_page is None for "to the last page".
+    """
+    if weight not in SHARD_WEIGHTS:
+        raise ValueError(f"Unknown shard weight {weight}. Choose one of {SHARD_WEIGHTS}.")
+    weights = [
+        os.path.getsize(path) if weight == "bytes" else page_count(path) for _, path in files
+    ]
+    n_shards = max(1, n_shards)
+    target = max(sum(weights) / n_shards, 1)
+
+    units = []  # (weight, name, start_page, end_page)
+    for (name, path), w in zip(files, weights):
+        n_pages = page_count(path) if w > target else None
+        n_parts = min(int(-(-w // target)), n_pages // min_split_pages) if n_pages else 1
+        if n_parts <= 1:
+            units.append((w, name, 1, None))
+            continue
+        bounds = [round(i * n_pages / n_parts) for i in range(n_parts + 1)]
+        for first, last in zip(bounds, bounds[1:]):
+            units.append((w * (last - first) / n_pages, name, first + 1, last))
+
+    # Longest processing time first: heaviest unit onto the lightest shard.
+    shards = [(0, i, []) for i in range(n_shards)]
+    for w, name, first, last in sorted(units, key=lambda u: -u[0]):
+        load, i, shard = heapq.heappop(shards)
+        shard.append((name, first, last))
+        heapq.heappush(shards, (load + w, i, shard))
+    return [sorted(shard, key=lambda u: (u[0], u[1])) for _, _, shard in sorted(shards) if shard]
+
+
+def _extract_pages(path, start_page, end_page):
+    """
+    Extract pages start_page..end_page (1-indexed, inclusive) with a fitz handle of its own.
+    Runs in pool workers, so it must stay a module-level function.
+    """
+    doc = _open_pdf(path)
     text_list = []
     for i in range(start_page - 1, end_page):
         text = doc.load_page(i).get_text("text")
@@ -26,39 +117,303 @@ def pdf_to_text(path, start_page=1, end_page=None):
     return text_list
 
 
-def text_to_chunks(texts, word_length=150, start_page=1):
-    text_toks = [(t["content"].split(" "), t["page"]) for t in texts]
-    chunks = []
-
-    for idx, words_and_page in enumerate(text_toks):
-        words = words_and_page[0]
-        page = words_and_page[1]
-        for i in range(0, len(words), word_length):
-            chunk = words[i : i + word_length]
-            if (
-                (i + word_length) > len(words)
-                and (len(chunk) < word_length)
-                and (len(text_toks) != (idx + 1))
-            ):
-                # text_toks[idx + 1] = chunk + text_toks[idx + 1]
-                text_toks[idx + 1] = (
-                    chunk + text_toks[idx + 1][0],
-                    text_toks[idx + 1][1],
-                )
-                continue
-            chunk = " ".join(chunk).strip()
-            chunk = f"[Page no. {idx+start_page}]" + " " + '"' + chunk + '"'
-            chunks.append((chunk, page))
+def make_pdf_executor(n_workers):
+    # spawn, not fork: the API process has threads, and fitz handles don't survive a fork.
+    return ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")
+    )
 
-    return chunks
 
+def iter_pdf_pages(
+    path,
+    start_page=1,
+    end_page=None,
+    n_workers=1,
+    pages_per_task=DEFAULT_PAGES_PER_TASK,
+    executor=None,
+):
+    """
+    Yield page dicts like {'content': '', 'page': int}, in page order, as soon as they are extracted.
+    With n_workers > 1, page ranges of pages_per_task pages are split across processes,
+    each opening its own fitz handle. Pass a long-lived executor from make_pdf_executor
+    to skip process startup. At most 2 ranges per worker are in flight,
+    so workers stay ahead of the consumer without extracting the whole PDF into memory.
+    """
+    if end_page is None:
+        end_page = page_count(path)
+    ranges = [
+        (first, min(first + pages_per_task - 1, end_page))
+        for first in range(start_page, end_page + 1, pages_per_task)
+    ]
+    if n_workers <= 1 or len(ranges) <= 1:
+        for first, last in ranges:
+            yield from _extract_pages(path, first, last)
+        return
 
-def download_pdf(url, save_path):
+    own_executor = executor is None
+    if own_executor:
+        executor = make_pdf_executor(min(n_workers, len(ranges)))
+    max_in_flight = 2 * n_workers
+    futures = []
+    next_range = 0
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        with open(save_path, "wb") as file:
-            file.write(response.content)
-        print(f"PDF downloaded successfully and saved to {save_path}")
-    except requests.exceptions.RequestException as e:
-        print(f"Failed to download PDF: {e}")
+        for i in range(len(ranges)):
+            while next_range < len(ranges) and len(futures) - i < max_in_flight:
+                futures.append(executor.submit(_extract_pages, path, *ranges[next_range]))
+                next_range += 1
+            yield from futures[i].result()
+            futures[i] = None
+    finally:
+        for f in futures:
+            if f is not None:
+                f.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def pdf_to_text(path, start_page=1, end_page=None, n_workers=1, executor=None):
+    return list(
+        iter_pdf_pages(
+            path, start_page, end_page, n_workers=n_workers, executor=executor
+        )
+    )
+
+
+################################################################
+# Chunking is based on this repo:
+# https://github.com/bhaskatripathi/pdfGPT/blob/main/api.py#L105
+################################################################
+
+
+class ChunkBuffer:
+    """
+    The text of a document as one string per page, with chunks stored as (start, end, page) spans
+    of character offsets into the pages joined by spaces.
+    Chunk strings with the "[Page no. N]" citation prefix are only rendered when indexed,
+    so cutting chunks never copies text, and holding chunks costs one copy of the text.
+
+    methods:
+        buffer[i] -> str:
+            Renders chunk i for a prompt or for the encoder.
+        text(i: int) -> str:
+            Text of chunk i, without the citation prefix.
+        page(i: int) -> int:
+            Page chunk i comes from.
+        span(i: int) -> Tuple[int, int]:
+            Character offsets of chunk i in the document.
+    """
+
+    def __init__(self):
+        self.page_texts = []
+        self.page_starts = array("q")  # Offset of each page; pages are joined by one space.
+        self.n_chars = 0
+        self.starts = array("q")
+        self.ends = array("q")
+        self.labels = array("l")  # Page number shown in the citation prefix.
+        self._pages = array("l")
+        self.text_nbytes = 0
+
+    def add_page(self, text):
+        """
+        Append one page, returning its offset.
+        """
+        start = self.n_chars + 1 if self.page_texts else 0
+        self.page_texts.append(text)
+        self.page_starts.append(start)
+        self.n_chars = start + len(text)
+        self.text_nbytes += sys.getsizeof(text)
+        return start
+
+    def add_span(self, start, end, label, page):
+        self.starts.append(start)
+        self.ends.append(end)
+        self.labels.append(label)
+        self._pages.append(page)
+        return len(self.starts) - 1
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return _render_chunk(self.text(i), self.labels[i])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def text(self, i):
+        start, end = self.starts[i], self.ends[i]
+        p = bisect.bisect_right(self.page_starts, start) - 1
+        parts = []
+        while p < len(self.page_texts) and self.page_starts[p] < end:
+            offset = self.page_starts[p]
+            parts.append(self.page_texts[p][max(start - offset, 0) : end - offset])
+            p += 1
+        return " ".join(parts).strip()
+
+    def page(self, i):
+        return self._pages[i]
+
+    def span(self, i):
+        return self.starts[i], self.ends[i]
+
+    @property
+    def pages(self):
+        return self._pages.tolist()
+
+    @property
+    def nbytes(self):
+        """
+        Resident size: the page strings, their list, and the span arrays.
+        """
+        arrays = (self.page_starts, self.starts, self.ends, self.labels, self._pages)
+        return (
+            self.text_nbytes
+            + sys.getsizeof(self.page_texts)
+            + sum(a.itemsize * len(a) for a in arrays)
+        )
+
+
+def iter_chunk_spans(texts, buffer, word_length=150, start_page=1):
+    """
+    Append each page to buffer as pages arrive from any iterable of page dicts,
+    e.g. the iter_pdf_pages generator, and yield the index of every chunk of word_length words.
+    Words left over at the end of a page start the next page's first chunk; nothing is copied
+    because a chunk is only a span over the buffer's page strings. Linear in the number of words.
+    """
+    n_words = 0
+    chunk_start = 0  # Words before the current chunk.
+    chunk_char = buffer.n_chars + 1 if buffer.page_texts else 0
+    idx, page = None, None
+    for idx, t in enumerate(texts):
+        words = t["content"].split(" ")
+        offset = buffer.add_page(t["content"])
+        page = t["page"]
+        first_word = n_words
+        n_words += len(words)
+        if n_words - chunk_start < word_length:
+            continue
+        # Offset of every word of this page, only for pages where a chunk ends.
+        word_starts = array("q", [offset])
+        for w in words[:-1]:
+            word_starts.append(word_starts[-1] + len(w) + 1)
+        while n_words - chunk_start >= word_length:
+            last = chunk_start + word_length - 1 - first_word
+            chunk_end = word_starts[last] + len(words[last])
+            yield buffer.add_span(chunk_char, chunk_end, idx + start_page, page)
+            chunk_start += word_length
+            chunk_char = chunk_end + 1
+    # The last page keeps its partial chunk.
+    if chunk_start < n_words:
+        yield buffer.add_span(chunk_char, buffer.n_chars, idx + start_page, page)
+
+
+def iter_chunks(texts, word_length=150, start_page=1):
+    """
+    Yield rendered (chunk, page) tuples as pages arrive.
+    """
+    buffer = ChunkBuffer()
+    for i in iter_chunk_spans(
+        texts, buffer, word_length=word_length, start_page=start_page
+    ):
+        yield buffer[i], buffer.page(i)
+
+
+def _render_chunk(text, page_label):
+    # TODO: Improve way to add page number citation.
+    # Rely less on LLM to do citation through token generation, maybe 🤨.
+    return f"[Page no. {page_label}]" + " " + '"' + text + '"'
+
+
+CITATION_PATTERN = re.compile(r'^\[Page no\. \d+\] "(.*)"$', re.DOTALL)
+
+
+def strip_citation(chunk):
+    """
+    Text of a rendered chunk, without the "[Page no. N]" prefix and quotes.
+    """
+    match = CITATION_PATTERN.match(chunk)
+    return match.group(1) if match else chunk
+
+
+def text_to_chunks(texts, word_length=150, start_page=1):
+    return list(iter_chunks(texts, word_length=word_length, start_page=start_page))
+
+
+def make_session(pool_size=DEFAULT_DOWNLOAD_WORKERS):
+    """
+    A requests session whose keep-alive connection pool fits pool_size concurrent downloads per host.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _is_retryable(error):
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+    return isinstance(
+        error,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            requests.exceptions.ChunkedEncodingError,
+        ),
+    )
+
+
+def download_pdf(
+    url,
+    save_path,
+    session=None,
+    timeout=DOWNLOAD_TIMEOUT,
+    retries=DOWNLOAD_RETRIES,
+    backoff=DOWNLOAD_BACKOFF,
+    chunk_size=1 << 20,
+):
+    """
+    Stream url to save_path, retrying transient failures with exponential backoff.
+    The body goes to a temporary file renamed into place, so save_path is never half written.
+    Returns True on success; failures are logged and return False.
+    """
+    session = session or requests
+    tmp_path = f"{save_path}.part"
+    for attempt in range(retries + 1):
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                with open(tmp_path, "wb") as file:
+                    for block in response.iter_content(chunk_size=chunk_size):
+                        file.write(block)
+            os.replace(tmp_path, save_path)
+            print(f"PDF downloaded successfully and saved to {save_path}")
+            return True
+        except requests.exceptions.RequestException as e:
+            if attempt < retries and _is_retryable(e):
+                delay = backoff * 2**attempt
+                print(f"[WARNING] Download of {url} failed ({e}), retrying in {delay:.0f}s.")
+                time.sleep(delay)
+                continue
+            print(f"Failed to download PDF: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+
+def download_pdfs(downloads, max_workers=DEFAULT_DOWNLOAD_WORKERS, **kwargs):
+    """
+    Download (url, save_path) pairs concurrently over one pooled session.
+    Returns one success flag per pair, in order. kwargs go to download_pdf.
+    """
+    downloads = list(downloads)
+    with make_session(pool_size=max_workers) as session:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download") as pool:
+            return list(
+                pool.map(
+                    lambda d: download_pdf(d[0], d[1], session=session, **kwargs), downloads
+                )
+            )
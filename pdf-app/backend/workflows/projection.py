@@ -0,0 +1,90 @@
+import numpy as np
+
+
+PROJECTIONS = ("tsne", "pca", "random")
+DEFAULT_MAX_POINTS = 5000
+
+
+def sample_per_file(files, max_points, seed=77):
+    """
+    Row indices of at most max_points chunks, stratified by file:
+    every file keeps one chunk, plus a share of the rest proportional to its chunk count.
+    With more files than max_points, one chunk of each of max_points random files.
+    Returns all rows, in order, when there are max_points or fewer.
+    """
+    n = len(files)
+    if n <= max_points:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    names, codes = np.unique(np.asarray(files, dtype=object), return_inverse=True)
+    n_files = len(names)
+    if n_files >= max_points:
+        # The first row of each file in a random order is a random row of that file.
+        order = rng.permutation(n)
+        _, first = np.unique(codes[order], return_index=True)
+        return np.sort(rng.choice(order[first], size=max_points, replace=False))
+    # Split the max_points - n_files spare rows by largest remainder, so shares sum to max_points.
+    quotas = (np.bincount(codes, minlength=n_files) - 1) * (max_points - n_files) / (n - n_files)
+    shares = 1 + np.floor(quotas).astype(int)
+    remainders = quotas - np.floor(quotas)
+    shares[np.argsort(-remainders, kind="stable")[: max_points - shares.sum()]] += 1
+    rows = []
+    for code in range(n_files):
+        members = np.flatnonzero(codes == code)
+        rows.append(rng.choice(members, size=shares[code], replace=False))
+    return np.sort(np.concatenate(rows))
+
+
+def project_2d(embeddings, method="pca", seed=77):
+    """
+    2-D coordinates of embeddings.
+    "pca" and "random" (Gaussian random projection) are linear and fast at any size;
+    "tsne" separates clusters better but is superlinear, so sample first.
+    """
+    if method not in PROJECTIONS:
+        raise ValueError(f"Unknown projection {method}. Choose one of {PROJECTIONS}.")
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if method == "tsne":
+        from sklearn.manifold import TSNE
+
+        perplexity = min(30, max(1, len(embeddings) - 1))
+        return TSNE(n_components=2, perplexity=perplexity, random_state=seed).fit_transform(
+            embeddings
+        )
+    centered = embeddings - embeddings.mean(axis=0)
+    if method == "pca":
+        # Top 2 right singular vectors are the first 2 principal axes.
+        _, _, vt = np.linalg.svd(centered, full_matrices=False)
+        return centered @ vt[:2].T
+    rng = np.random.default_rng(seed)
+    return centered @ rng.normal(size=(embeddings.shape[1], 2)) / np.sqrt(2)
+
+
+def embedding_chart(
+    embeddings, chunks, files, method="pca", max_points=DEFAULT_MAX_POINTS, n_total=None
+):
+    """
+    Altair scatter plot of chunk embeddings in 2-D, colored by file,
+    on a per-file stratified sample of at most max_points chunks.
+    n_total is the corpus size for the title, when the caller already sampled it.
+    """
+    import altair as alt
+    import pandas as pd
+
+    rows = sample_per_file(files, max_points)
+    embeddings_2d = project_2d(np.asarray(embeddings)[rows], method=method)
+
+    df = pd.DataFrame(embeddings_2d, columns=["x", "y"])
+    df["text"] = [chunks[i] for i in rows]
+    df["file"] = [files[i] for i in rows]
+
+    n_total = n_total or len(files)
+    title = "Text Embeddings Visualization"
+    if len(rows) < n_total:
+        title += f" ({len(rows)} of {n_total} chunks)"
+    return (
+        alt.Chart(df)
+        .mark_circle(size=60)
+        .encode(x="x", y="y", tooltip=["text"], color="file")
+        .properties(title=title, width=500, height=350)
+    )
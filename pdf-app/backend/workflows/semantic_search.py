@@ -1,13 +1,13 @@
-from sklearn.neighbors import NearestNeighbors
-from sklearn.manifold import TSNE
-from sentence_transformers import SentenceTransformer
-import altair as alt
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 import json
 
+from nn_index import make_index
+from bm25 import HybridSearch
+from pdf_utils import strip_citation
+from encoders import EmbeddingPool, load_encoder
+
 
 TEXT_EMBEDDING_MODEL_INFO = {
     "model_name": "all-MiniLM-L6-v2",
@@ -22,21 +22,107 @@ class SemanticSearchModel:
     Manager for a semantic search model.
 
     args:
-        None
+        embedding_cache: EmbeddingCache
+            Optional. When given, only chunks missing from the cache are encoded.
+        index_backend: str
+            Nearest neighbor backend, "exact", "hnsw" or "ivf". Use an approximate one at corpus scale.
+        index_params: Dict
+            Build and query parameters for the backend, e.g. {"n_probe": 16}.
+        compact_ratio: float
+            Rebuild the index without removed chunks once they are this fraction of it.
+        embedding_backend: str
+            Encoder backend, "torch" (sentence-transformers) or "onnx" (ONNX Runtime).
+        embedding_params: Dict
+            Encoder parameters, e.g. {"quantize": true, "num_threads": 4}. See encoders.OnnxEncoder.
+        embedding_workers: int
+            With more than 1, chunks are encoded on a pool of processes, each with its own model copy
+            and embedding_params["num_threads"] threads (default 2). Call close() when done.
+        hybrid_params: Dict
+            When given, queries go through a BM25 prefilter and a dense rerank of its candidates,
+            e.g. {"n_candidates": 200, "fusion": "rrf"}. See bm25.HybridSearch.
 
     methods:
         fit(data: List[str], batch: int, n_neighbors: int) -> None:
             Fits the model M with the data.
+        embed(chunks: List[str], files: List[str], batch: int) -> np.ndarray:
+            Embeds chunks without fitting, for one shard of a larger corpus.
+        fit_embeddings(chunks: List[str], files: List[str], embeddings: np.ndarray, n_neighbors: int, pages: List[int]) -> None:
+            Fits the model M from precomputed embeddings, without encoding.
+        resume(chunks, files, embeddings, nn, deleted, pages, n_neighbors) -> None:
+            Restores a fitted model from its parts, e.g. a previous flow run, to add to and remove from.
+        add(chunks: List[str], files: List[str], batch: int, embeddings: np.ndarray, pages: List[int]) -> None:
+            Embeds only the new chunks, unless embeddings are given, and appends them to the fitted index.
+        remove(doc_id: Union[str, Iterable[str]]) -> int:
+            Tombstones every chunk of one or more files. Returns how many were removed.
+        rename(names: Dict[str, str]) -> None:
+            Relabels the chunks of files, e.g. renamed but unchanged ones.
+        compact() -> None:
+            Drops removed chunks and rebuilds the index from the remaining embeddings, without re-encoding.
+        save(store: IndexStore, key: str, pages: List[int]) -> None:
+            Persists the embeddings, chunks and files of a fitted model.
+        load(store: IndexStore, key: str, n_neighbors: int) -> None:
+            Memory-maps a saved model back in, without re-encoding.
+        search_batch(queries: List[str], k: int) -> Tuple[np.ndarray, np.ndarray]:
+            Returns (indices, scores) of the k nearest chunks of every query, scores being cosine similarity.
         _get_text_embedding(texts: List[str], batch: int) -> np.ndarray:
             Returns the embeddings of the text.
     """
 
-    def __init__(self):
-        self.embedding_model = SentenceTransformer(
-            TEXT_EMBEDDING_MODEL_INFO["model_name"]
-        )
+    def __init__(
+        self,
+        embedding_cache=None,
+        index_backend="exact",
+        index_params=None,
+        compact_ratio=0.2,
+        hybrid_params=None,
+        embedding_backend="torch",
+        embedding_params=None,
+        embedding_workers=1,
+    ):
+        embedding_params = embedding_params or {}
+        self.embedding_backend = embedding_backend
+        self.embedding_params = embedding_params
+        self._embedding_model = None
+        self.embedding_pool = None
+        if embedding_workers > 1:
+            params = dict(embedding_params)
+            self.embedding_pool = EmbeddingPool(
+                TEXT_EMBEDDING_MODEL_INFO["model_name"],
+                n_workers=embedding_workers,
+                threads_per_worker=params.pop("num_threads", 2),
+                backend=embedding_backend,
+                params=params,
+            )
+        self.embedding_cache = embedding_cache
+        self.index_backend = index_backend
+        self.index_params = index_params or {}
+        self.compact_ratio = compact_ratio
+        self.hybrid_params = hybrid_params
         self.fitted = False
 
+    @property
+    def embedding_model(self):
+        # Loaded on first use: fitting from precomputed embeddings never needs the model.
+        if self._embedding_model is None:
+            self._embedding_model = load_encoder(
+                TEXT_EMBEDDING_MODEL_INFO["model_name"],
+                self.embedding_backend,
+                **self.embedding_params,
+            )
+        return self._embedding_model
+
+    def _encode(self, texts):
+        # Chunks go to the pool when there is one; single queries are not worth a round trip.
+        encoder = self.embedding_pool or self.embedding_model
+        if self.embedding_cache is None:
+            return encoder.encode(texts)
+        return self.embedding_cache.encode(texts, encoder.encode)
+
+    def close(self):
+        if self.embedding_pool is not None:
+            self.embedding_pool.close()
+            self.embedding_pool = None
+
     def _get_text_embedding(self, texts, files, batch_size=1000):
         """
         Gather a stack of embedded texts, packed batch_size at a time.
@@ -44,62 +130,194 @@ class SemanticSearchModel:
         embeddings = []
         file_emb = []
         n_texts = len(texts)
+        if self.embedding_pool is not None:
+            # Enough texts per call to keep every worker busy.
+            batch_size *= self.embedding_pool.n_workers
         for batch_start_idx in range(0, n_texts, batch_size):
             file_batch = files[batch_start_idx : (batch_start_idx + batch_size)]
             text_batch = texts[batch_start_idx : (batch_start_idx + batch_size)]
-            embedding_batch = self.embedding_model.encode(text_batch)
+            embedding_batch = self._encode(text_batch)
             embeddings.append(embedding_batch)
             file_emb.append(file_batch)
 
         print("[DEBUG] Embedding batches:", len(embeddings))
         embeddings = np.vstack(embeddings)
-        file_emb = np.array(file_emb)
+        # Flatten: the last batch is usually shorter, and numpy refuses ragged arrays.
+        file_emb = np.array([f for file_batch in file_emb for f in file_batch])
         print("[DEBUG] Embedding reshaped:", embeddings.shape, file_emb.shape)
         return embeddings, file_emb
 
+    def embed(self, chunks, files, batch_size=1000):
+        """
+        Embeddings of chunks without fitting an index, e.g. for one shard of a corpus.
+        """
+        embeddings, _ = self._get_text_embedding(chunks, files, batch_size=batch_size)
+        return embeddings
+
     def fit(self, chunks, files, batch_size=1000, n_neighbors=6):
         """
-        The only public method in this class.
         Fits the model with the data when a new PDF is uploaded.
         """
+        embeddings = self.embed(chunks, files, batch_size=batch_size)
+        return self.fit_embeddings(chunks, files, embeddings, n_neighbors=n_neighbors)
+
+    def fit_embeddings(self, chunks, files, embeddings, n_neighbors=6, pages=None):
+        """
+        Fits the model on chunks embedded elsewhere, e.g. shards from parallel tasks, in order.
+        """
+        if len(embeddings) != len(chunks):
+            raise ValueError(f"{len(embeddings)} embeddings for {len(chunks)} chunks.")
         self.chunks = chunks
-        self.embeddings, _ = self._get_text_embedding(
-            self.chunks, files, batch_size=batch_size
-        )
-        n_neighbors = min(n_neighbors, len(self.embeddings))
-        print(
-            "[DEBUG] Fitting Nearest Neighbors model with %s neighbors." % n_neighbors
-        )
-        self.nn = NearestNeighbors(n_neighbors=n_neighbors)
-        self.nn.fit(self.embeddings)
-        print("[DEBUG] Fit complete.")
-        self.fitted = True
+        self.files = files
+        self.pages = pages
+        self.embeddings = embeddings
+        self._fit_nn(n_neighbors)
+
+    def resume(
+        self, chunks, files, embeddings, nn=None, deleted=None, pages=None, n_neighbors=6
+    ):
+        """
+        Restores a fitted model from the parts of one, e.g. the artifacts of a previous flow run,
+        so it can be updated with add() and remove() instead of refit.
+        Without nn, or with one built with other index parameters, the index is rebuilt from the embeddings.
+        """
+        self.chunks = list(chunks)
+        self.files = list(files)
+        self.pages = list(pages) if pages is not None else None
+        self.embeddings = embeddings
+        deleted = np.zeros(len(embeddings), dtype=bool) if deleted is None else deleted
+        self._fit_nn(n_neighbors, nn=nn)
+        if nn is None and deleted.any():
+            self.nn.remove(np.flatnonzero(deleted))
+        self.deleted = np.array(deleted, dtype=bool)
+        self.n_neighbors = min(self.max_neighbors, int((~self.deleted).sum()))
 
-        tsne = TSNE(n_components=2, random_state=77)
-        embeddings_2d = tsne.fit_transform(self.embeddings)
-
-        df = pd.DataFrame(embeddings_2d, columns=["x", "y"])
-        df["text"] = self.chunks
-        df["file"] = files
-
-        chart = (
-            alt.Chart(df)
-            .mark_circle(size=60)
-            .encode(
-                x="x",
-                y="y",
-                tooltip=["text"],
-                color="file"
+    def _fit_nn(self, n_neighbors, nn=None):
+        self.max_neighbors = n_neighbors
+        self.n_neighbors = min(n_neighbors, len(self.embeddings))
+        if nn is None:
+            print(
+                "[DEBUG] Fitting %s Nearest Neighbors model with %s neighbors."
+                % (self.index_backend, self.n_neighbors)
             )
-            .properties(
-                title="Text Embeddings Visualization",
-                width=500,
-                height=350
+            nn = make_index(
+                self.index_backend, n_neighbors=self.n_neighbors, **self.index_params
+            ).build(self.embeddings)
+        elif hasattr(nn, "attach_vectors"):
+            # Unpickled quantized indexes come without their float32 rescoring vectors.
+            nn.attach_vectors(self.embeddings)
+        self.nn = nn
+        self.deleted = np.zeros(len(self.embeddings), dtype=bool)
+        self.hybrid = None
+        if self.hybrid_params is not None:
+            self.hybrid = HybridSearch(**self.hybrid_params).build(
+                [strip_citation(c) for c in self.chunks]
             )
+        print("[DEBUG] Fit complete.")
+        self.fitted = True
+
+    def add(self, chunks, files, batch_size=1000, embeddings=None, pages=None):
+        """
+        Add chunks of new or changed files to a fitted model in place.
+        Only the new chunks are encoded, unless their embeddings are given;
+        the index appends their vectors instead of rebuilding.
+        """
+        if not self.fitted:
+            if embeddings is not None:
+                return self.fit_embeddings(chunks, files, embeddings, pages=pages)
+            return self.fit(chunks, files, batch_size=batch_size)
+        if not len(chunks):
+            return
+        if embeddings is None:
+            embeddings, _ = self._get_text_embedding(chunks, files, batch_size=batch_size)
+        self.nn.add(embeddings)
+        if self.hybrid is not None:
+            self.hybrid.add([strip_citation(c) for c in chunks])
+        self.embeddings = np.concatenate([self.embeddings, embeddings])
+        self.chunks = list(self.chunks) + list(chunks)
+        self.files = list(self.files) + list(files)
+        if self.pages is not None:
+            self.pages = list(self.pages) + list(pages)
+        self.deleted = np.concatenate([self.deleted, np.zeros(len(chunks), dtype=bool)])
+        self.n_neighbors = min(self.max_neighbors, int((~self.deleted).sum()))
+        print("[DEBUG] Added %s chunks, index size %s." % (len(chunks), len(self.chunks)))
+
+    def remove(self, doc_id):
+        """
+        Remove every chunk of one file, or of each file in an iterable of them.
+        Chunks are tombstoned, and never returned by searches,
+        until removed chunks reach compact_ratio of the index and it is compacted.
+        """
+        doc_ids = {doc_id} if isinstance(doc_id, str) else set(doc_id)
+        ids = np.array(
+            [i for i, f in enumerate(self.files) if f in doc_ids and not self.deleted[i]],
+            dtype=np.int64,
         )
+        if not len(ids):
+            return 0
+        self.nn.remove(ids)
+        self.deleted[ids] = True
+        self.n_neighbors = min(self.max_neighbors, int((~self.deleted).sum()))
+        print("[DEBUG] Removed %s chunks of %s files." % (len(ids), len(doc_ids)))
+        if self.deleted.mean() >= self.compact_ratio:
+            self.compact()
+        return len(ids)
 
-        return chart
+    def rename(self, names):
+        """
+        Relabel the chunks of each file in names (old name to new name), all at once,
+        so names can be swapped.
+        """
+        self.files = [names.get(f, f) for f in self.files]
 
+    def compact(self):
+        if not self.deleted.any():
+            return
+        keep = np.flatnonzero(~self.deleted)
+        print("[DEBUG] Compacting index from %s to %s chunks." % (len(self.deleted), len(keep)))
+        self.embeddings = np.asarray(self.embeddings)[keep]
+        self.chunks = [self.chunks[i] for i in keep]
+        self.files = [self.files[i] for i in keep]
+        if self.pages is not None:
+            self.pages = [self.pages[i] for i in keep]
+        self._fit_nn(self.max_neighbors)
+
+    def save(self, store, key, pages=None):
+        self.compact()
+        pages = self.pages if pages is None else pages
+        store.save(key, self.embeddings, self.chunks, pages=pages, files=self.files)
+
+    def load(self, store, key, n_neighbors=6):
+        """
+        Restore a model saved with save(). The embedding matrix stays memory-mapped.
+        """
+        self.embeddings, metadata = store.load(key)
+        self.chunks = metadata["chunks"]
+        self.files = metadata["files"]
+        self.pages = metadata["pages"]
+        self._fit_nn(n_neighbors)
+        return metadata
+
+    def search_batch(self, queries, k=6, batch_size=1000):
+        """
+        Encode all queries in one batch and search them together. For evaluations and batch Q&A.
+        """
+        queries = list(queries)
+        embeddings = self.embedding_model.encode(queries, batch_size=batch_size)
+        return self._search(queries, embeddings, k)
+
+    def _search(self, queries, embeddings, k):
+        if self.hybrid is None:
+            return self.nn.search(embeddings, k)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, embedding) in enumerate(zip(queries, embeddings)):
+            ids, fused = self.hybrid.search(
+                query, embedding, self.embeddings, self.nn, k, self.deleted
+            )
+            indices[i, : len(ids)] = ids
+            scores[i, : len(ids)] = fused
+        return indices, scores
 
     def __call__(self, text, return_data=True):
         """
@@ -109,9 +327,11 @@ class SemanticSearchModel:
         print("[DEBUG] Getting nearest neighbors of text:", text)
         embedding = self.embedding_model.encode([text])
         print("[DEBUG] Embedding:", embedding.shape)
-        neighbors = self.nn.kneighbors(embedding, return_distance=False)[0]
+        neighbors = self._search([text], embedding, self.n_neighbors)[0][0]
+        # Approximate backends pad with -1 when they find fewer than k candidates.
+        neighbors = neighbors[neighbors >= 0]
         if return_data:
-            return [self.data[text_neighbs] for text_neighbs in neighbors]
+            return [self.chunks[text_neighbs] for text_neighbs in neighbors]
         else:
             return neighbors
 
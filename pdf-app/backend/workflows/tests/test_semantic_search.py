@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from nn_index import INDEX_BACKENDS
+from semantic_search import SemanticSearchModel
+
+
+def embeddings(n, seed):
+    return np.random.default_rng(seed).normal(size=(n, 16)).astype(np.float32)
+
+
+@pytest.mark.parametrize("backend", list(INDEX_BACKENDS))
+def test_remove_every_chunk_then_add(backend):
+    if backend == "hnsw":
+        pytest.importorskip("hnswlib")
+    model = SemanticSearchModel(index_backend=backend)
+    model.fit_embeddings(["a 0", "a 1", "a 2"], ["a"] * 3, embeddings(3, 0))
+    model.add(["b 0", "b 1"], ["b"] * 2, embeddings=embeddings(2, 1))
+    model.remove("a")
+    model.remove("b")
+    assert len(model.embeddings) == 0
+    assert model._search(["a 0"], embeddings(1, 0), model.n_neighbors)[0].shape == (1, 0)
+
+    new = embeddings(4, 2)
+    model.add([f"c {i}" for i in range(4)], ["c"] * 4, embeddings=new)
+    indices, _ = model._search(["c 2"], new[2:3], model.n_neighbors)
+    assert model.n_neighbors == 4
+    assert indices[0][0] == 2
+    assert sorted(indices[0]) == [0, 1, 2, 3]